@@ -1,5 +1,7 @@
 # API:  code available for export
 from admin import RepositoryHookAdmin
+from githooksystem import GitHookSystem
+from hghooksystem import HgHookSystem
 from interface import IRepositoryChangeListener
 from interface import IRepositoryHookSubscriber
 from listener import RepositoryChangeListener
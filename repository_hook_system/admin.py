@@ -4,8 +4,10 @@ admin panel interface for controlling hook setup and listeners
 """
 
 from pkg_resources import resource_filename
+from repository_hook_system.dispatch import supports
 from repository_hook_system.interface import IRepositoryHookSystem
 from repository_hook_system.interface import IRepositoryHookSubscriber
+from repository_hook_system.metrics import HookMetrics
 from trac.admin.api import IAdminPanelProvider
 from trac.config import Option
 from trac.core import *
@@ -106,6 +108,8 @@ class RepositoryHookAdmin(Component):
 
             # process posted options to configuration
             for listener in self.listeners:
+                if not supports(listener, hookname):
+                    continue # not on the form
                 name = listener.__class__.__name__
                 options = self.options(listener)
                 args = dict([(key.split('%s-' % name, 1)[1], value) 
@@ -129,12 +133,17 @@ class RepositoryHookAdmin(Component):
 
         data['listeners'] = []
         for listener in self.listeners:
+            if not supports(listener, hookname):
+                continue
             _cls = listener.__class__
             data['listeners'].append(dict(name=_cls.__name__, 
                                           activated=(_cls.__name__ in activated),
                                           description=listener.__doc__,
                                           options=self.options(listener)))
 
+        # latencies of the phases and subscribers of the hook
+        data['metrics'] = HookMetrics(self.env).summary(hookname)
+
         return ('repositoryhooks.html', data)
 
     def options(self, listener):
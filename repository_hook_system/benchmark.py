@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""
+end-to-end benchmark of the hook system
+
+For each scenario, a throwaway svn repository (`svnadmin create`) and
+trac environments are made in a temporary directory, the pre-commit
+and post-commit hooks are enabled through SVNHookSystem and commits
+are made with `svn commit`.  The timings of the phases of the hooks are
+taken from the stats the listener records (see metrics.py).  This needs
+svn, svnadmin and svnlook and the python svn bindings trac uses.
+
+  python benchmark.py [--commits 10] [--message-sizes 100,100000]
+                      [--references 1,10] [--subscribers 0,4]
+                      [--projects 1,3] [--sync-policies hook,always]
+                      [--output results.json] [--compare previous.json]
+
+The scenarios are all combinations of the message sizes, ticket
+references per message, numbers of extra (no-op) subscribers, numbers
+of projects on the hook line and repository sync policies (the
+`sync-policy` option of SVNHookSystem;  compare them with
+`--sync-policies hook,always`).  Results are written as JSON;  with
+--compare, the mean timings are checked against an earlier run and the
+exit status is 1 if a phase got slower by more than --tolerance.  A
+scenario whose hooks failed, or didn't run every phase once per commit
+and project, stops the benchmark with an error
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from optparse import OptionParser
+from repository_hook_system.metrics import HookMetrics
+from repository_hook_system.metrics import percentile
+from repository_hook_system.svnhooksystem import SVNHookSystem
+from trac.env import Environment
+from trac.env import open_environment
+from trac.ticket import Ticket
+
+# no-op subscribers, loaded from the plugins directory of the environments
+subscriber_plugin = '''
+from repository_hook_system.interface import IRepositoryHookSubscriber
+from trac.core import *
+
+class NullSubscriber(object):
+    """looks at the changeset the way a simple subscriber would"""
+    def is_available(self, repository, hookname):
+        return True
+    def invoke(self, changeset):
+        changeset.message
+        list(changeset.get_changes())
+%s
+'''
+subscriber_class = '''
+class NullSubscriber%d(NullSubscriber, Component):
+    implements(IRepositoryHookSubscriber)
+'''
+
+# phases reported, as (name, hook, phase, subscriber) of the stats
+phases = [ ('open_environment', 'post-commit', 'open', ''),
+           ('pre-commit sync', 'pre-commit', 'sync', ''),
+           ('repo.sync', 'post-commit', 'sync', ''),
+           ('svnlook', 'pre-commit', 'changeset', ''),
+           ('get_changeset', 'post-commit', 'changeset', ''),
+           ('TicketChanger', 'post-commit', 'invoke', 'TicketChanger') ]
+
+def which(program):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, program)
+        if os.access(path, os.X_OK):
+            return path
+    return program
+
+def call(*command):
+    """run a command, raising on failure;  returns its output"""
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise Exception('%s failed:\n%s' % (' '.join(command), output))
+    return output
+
+def python_path():
+    """the path the hooks need to import trac and this plugin"""
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = [ package ] + [ path for path in sys.path if path ]
+    return os.pathsep.join(paths)
+
+class Fixture(object):
+    """svn repository with trac environments hooked to it"""
+
+    def __init__(self, projects, subscribers, tickets, sync_policy='hook'):
+        self.directory = tempfile.mkdtemp(prefix='hook-benchmark-')
+        self.repository = os.path.join(self.directory, 'repository')
+        self.working_copy = os.path.join(self.directory, 'wc')
+        call('svnadmin', 'create', self.repository)
+        call('svn', 'checkout', '-q', 'file://' + self.repository,
+             self.working_copy)
+        self.projects = [ self.environment('project%d' % index, subscribers,
+                                           tickets, sync_policy)
+                          for index in range(projects) ]
+        self.revision = 0
+
+    def environment(self, name, subscribers, tickets, sync_policy):
+        """create a trac environment with hooks enabled"""
+        path = os.path.join(self.directory, name)
+        env = Environment(path, create=True,
+                          options=[ ('project', 'name', name),
+                                    ('trac', 'repository_type', 'svn'),
+                                    ('trac', 'repository_dir', self.repository),
+                                    ('svn', 'svnlook', which('svnlook')),
+                                    ('repository-hook-system', 'sync-policy', sync_policy),
+                                    ('components', 'repository_hook_system.*', 'enabled'),
+                                    ('components', 'null_subscribers.*', 'enabled') ])
+
+        # no-op subscribers on both hooks, the TicketChanger after commit
+        null = [ 'NullSubscriber%d' % index for index in range(subscribers) ]
+        plugin = file(os.path.join(path, 'plugins', 'null_subscribers.py'), 'w')
+        plugin.write(subscriber_plugin % ''.join([ subscriber_class % index
+                                                   for index in range(subscribers) ]))
+        plugin.close()
+        env.config.set('repository-hooks', 'pre-commit', ', '.join(null))
+        env.config.set('repository-hooks', 'post-commit',
+                       ', '.join(['TicketChanger'] + null))
+        env.config.save()
+
+        for index in range(tickets):
+            ticket = Ticket(env)
+            ticket['summary'] = 'ticket %d' % (index + 1)
+            ticket['reporter'] = 'benchmark'
+            ticket.insert()
+
+        system = SVNHookSystem(env)
+        for hookname in ('pre-commit', 'post-commit'):
+            # hooks run with an empty environment
+            export = 'export PYTHONPATH=%s' % python_path()
+            system.update(hookname,
+                          lambda hook_file: hook_file is None and
+                          system.stub(hookname) + [ export ] or None)
+            system.enable(hookname)
+        return path
+
+    def commit(self, message):
+        """commit a change with the message;  returns the seconds taken"""
+        self.revision += 1
+        f = file(os.path.join(self.working_copy, 'file.txt'), 'w')
+        print >> f, self.revision
+        f.close()
+        if self.revision == 1:
+            call('svn', 'add', '-q', os.path.join(self.working_copy, 'file.txt'))
+        message_file = os.path.join(self.directory, 'message')
+        f = file(message_file, 'w')
+        f.write(message)
+        f.close()
+        start = time.time()
+        call('svn', 'commit', '-q', '-F', message_file, self.working_copy)
+        return time.time() - start
+
+    def stats(self):
+        """the hook stats of all projects, added together"""
+        retval = {}
+        for project in self.projects:
+            stats = HookMetrics(open_environment(project)).stats()
+            for key, entry in stats.items():
+                total = retval.setdefault(key, dict(count=0, errors=0, sum=0.,
+                                                    buckets=[0] * len(entry['buckets'])))
+                total['count'] += entry['count']
+                total['errors'] += entry['errors']
+                total['sum'] += entry['sum']
+                total['buckets'] = [ a + b for a, b in zip(total['buckets'],
+                                                           entry['buckets']) ]
+        return retval
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def message(size, references):
+    """commit message of about size bytes referencing tickets"""
+    retval = 'refs %s\n' % ', '.join([ '#%d' % (index + 1)
+                                       for index in range(references) ])
+    filler = 'benchmark commit message text '
+    return retval + filler * max(0, (size - len(retval)) / len(filler))
+
+def startup(code, count=5):
+    """median seconds to start python and run the code"""
+    environ = dict(os.environ, PYTHONPATH=python_path())
+    timings = []
+    for index in range(count):
+        start = time.time()
+        subprocess.call([ sys.executable, '-c', code ], env=environ)
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) / 2]
+
+def summary(entries):
+    """mean and estimated p50/p95 of the timings in the stats entries"""
+    count = sum([ entry['count'] for entry in entries ])
+    if not count:
+        return None
+    buckets = [ sum(counts) for counts in zip(*[ entry['buckets'] for entry in entries ]) ]
+    return dict(count=count,
+                errors=sum([ entry['errors'] for entry in entries ]),
+                mean=sum([ entry['sum'] for entry in entries ]) / count,
+                p50=percentile(buckets, 0.5),
+                p95=percentile(buckets, 0.95))
+
+def check(stats, commits, subscribers, projects):
+    """
+    the problems of the stats of a scenario:  failed phases, and phases
+    not run once per commit and project, e.g. as a hook broke before
+    recording them (svn only warns of a failed post-commit)
+    """
+    expected = dict([ ((hook, phase, subscriber), commits * projects)
+                      for name, hook, phase, subscriber in phases ])
+    for index in range(subscribers):
+        for hook in ('pre-commit', 'post-commit'):
+            expected[(hook, 'invoke', 'NullSubscriber%d' % index)] = commits * projects
+    problems = []
+    for key, count in sorted(expected.items()):
+        entry = stats.get(key, dict(count=0, errors=0))
+        if entry['count'] != count:
+            problems.append('%s: ran %d times, not %d' % ('|'.join(key), entry['count'], count))
+    for key, entry in sorted(stats.items()):
+        if entry['errors']:
+            problems.append('%s: failed %d times' % ('|'.join(key), entry['errors']))
+    return problems
+
+def scenario(commits, size, references, subscribers, projects, sync_policy):
+    """
+    run commits in a new fixture;  returns the results, or raises if
+    the hooks didn't all run
+    """
+    fixture = Fixture(projects, subscribers, references, sync_policy)
+    try:
+        commit_times = [ fixture.commit(message(size, references))
+                         for index in range(commits) ]
+        stats = fixture.stats()
+    finally:
+        fixture.cleanup()
+    problems = check(stats, commits, subscribers, projects)
+    if problems:
+        raise Exception('the hooks failed (see the trac logs):\n  %s'
+                        % '\n  '.join(problems))
+
+    results = dict(message_size=size, references=references,
+                   subscribers=subscribers, projects=projects,
+                   sync_policy=sync_policy, commits=commits,
+                   commit=sum(commit_times) / len(commit_times),
+                   phases={}, stats={})
+    for name, hook, phase, subscriber in phases:
+        if (hook, phase, subscriber) in stats:
+            results['phases'][name] = summary([stats[(hook, phase, subscriber)]])
+    null = [ entry for (hook, phase, subscriber), entry in stats.items()
+             if subscriber.startswith('NullSubscriber') ]
+    if null:
+        results['phases']['NullSubscriber'] = summary(null)
+    results['stats'] = dict([ ('|'.join(key), entry)
+                              for key, entry in stats.items() ])
+    return results
+
+def compare(results, previous, tolerance):
+    """
+    compare the mean timings with those of an earlier run;
+    returns the regressions as strings
+    """
+    def key(scenario):
+        return (scenario['message_size'], scenario['references'],
+                scenario['subscribers'], scenario['projects'],
+                scenario.get('sync_policy', 'always'))
+    earlier = dict([ (key(scenario), scenario) for scenario in previous['scenarios'] ])
+    regressions = []
+    for scenario in results['scenarios']:
+        before = earlier.get(key(scenario))
+        if before is None:
+            continue
+        timings = [ ('commit', scenario['commit'], before['commit']) ]
+        for name, phase in scenario['phases'].items():
+            if name in before['phases']:
+                timings.append((name, phase['mean'], before['phases'][name]['mean']))
+        for name, now, then in timings:
+            if then and now > then * (1 + tolerance):
+                regressions.append('%r %s: %.4fs -> %.4fs' % (key(scenario), name, then, now))
+    return regressions
+
+def integers(option):
+    return [ int(value) for value in option.split(',') if value.strip() ]
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser()
+    parser.add_option('--commits', dest='commits', type='int', default=10,
+                      help='commits per scenario [DEFAULT: %default]')
+    parser.add_option('--message-sizes', dest='sizes', default='100,100000',
+                      help='sizes of the commit messages [DEFAULT: %default]')
+    parser.add_option('--references', dest='references', default='1,10',
+                      help='ticket references per message [DEFAULT: %default]')
+    parser.add_option('--subscribers', dest='subscribers', default='0,4',
+                      help='no-op subscribers per hook [DEFAULT: %default]')
+    parser.add_option('--projects', dest='projects', default='1,3',
+                      help='projects on the hook line [DEFAULT: %default]')
+    parser.add_option('--sync-policies', dest='sync_policies', default='hook',
+                      help='repository sync policies [DEFAULT: %default]')
+    parser.add_option('-o', '--output', dest='output',
+                      help='file to write the JSON results to')
+    parser.add_option('--compare', dest='compare',
+                      help='JSON results of an earlier run to compare with')
+    parser.add_option('--tolerance', dest='tolerance', type='float', default=0.2,
+                      help='relative slowdown counted as a regression [DEFAULT: %default]')
+    options, args = parser.parse_args(args)
+
+    results = dict(python=sys.version.split()[0],
+                   started=time.time(),
+                   interpreter_start=startup('pass'),
+                   listener_import=startup('import repository_hook_system.listener'),
+                   scenarios=[])
+    for size in integers(options.sizes):
+        for references in integers(options.references):
+            for subscribers in integers(options.subscribers):
+                for projects in integers(options.projects):
+                    for sync_policy in options.sync_policies.split(','):
+                        result = scenario(options.commits, size, references,
+                                          subscribers, projects, sync_policy.strip())
+                        results['scenarios'].append(result)
+                        print 'size=%-7d refs=%-3d subscribers=%-3d projects=%-3d sync=%-6s commit: %.3fs' % (
+                            size, references, subscribers, projects, result['sync_policy'], result['commit'])
+                        for name, phase in sorted(result['phases'].items()):
+                            print '    %-18s mean: %.4fs  p50: %.4fs  p95: %.4fs' % (
+                                name, phase['mean'], phase['p50'], phase['p95'])
+    print 'interpreter start: %.4fs' % results['interpreter_start']
+    print 'interpreter start and listener import: %.4fs' % results['listener_import']
+
+    if options.output:
+        f = file(options.output, 'w')
+        json.dump(results, f, indent=2)
+        f.close()
+
+    if options.compare:
+        f = file(options.compare)
+        previous = json.load(f)
+        f.close()
+        regressions = compare(results, previous, options.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, 'REGRESSION: %s' % regression
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
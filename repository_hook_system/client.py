@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+minimal hook client for the repository hook system
+
+This is the file invoked from the repository hook scripts.  It forwards
+the (projects, hook, arguments) of the invocation to a running
+listener daemon (see daemon.py) so that neither python's site packages
+nor trac need to be loaded on every commit.  If no daemon is listening,
+or the hook sees the changes through its environment, as git's
+pre-receive does in quarantine, the hook is run in-process as by
+listener.py
+
+This module should only import from the standard library so that
+it stays cheap to start
+"""
+
+import os
+import socket
+import sys
+
+from optparse import OptionParser
+
+# in a directory of the user's own rather than /tmp, where anyone
+# could make the socket first and answer the hooks
+default_socket = os.path.join(os.path.expanduser('~'),
+                              '.trac-repository-hooks', 'socket')
+
+# variables through which a pre-type hook sees the changes it is asked
+# about, which aren't in the repository yet (git's quarantine, hg's
+# pending transaction);  a daemon doesn't have them
+pending_environment = [ 'GIT_QUARANTINE_PATH', 'GIT_OBJECT_DIRECTORY',
+                        'GIT_ALTERNATE_OBJECT_DIRECTORIES', 'HG_PENDING' ]
+
+def filename():
+    return os.path.abspath(__file__.rstrip('c'))
+
+def option_parser():
+    parser = OptionParser()
+    parser.add_option('-p', '--project', '--projects',
+                      dest='projects', action='append',
+                      default=[],
+                      help='projects to apply to',
+                      )
+    parser.add_option('--hook',
+                      dest='hook',
+                      help='hook called')
+    parser.add_option('--socket',
+                      dest='socket', default=default_socket,
+                      help='unix socket of the listener daemon [DEFAULT: %default]')
+    parser.add_option('--stdin',
+                      dest='stdin', action='store_true', default=False,
+                      help='pass the standard input of the hook as the last argument')
+    parser.add_option('-j', '--jobs',
+                      dest='jobs', type='int', default=1,
+                      help='number of processes running the projects concurrently [DEFAULT: %default]')
+    parser.add_option('--coalesce', metavar='SECONDS',
+                      dest='coalesce', type='float', default=None,
+                      help='merge a burst of post-commit hooks into one run over the range of revisions (see coalesce.py), waiting SECONDS for it to pile up')
+    return parser
+
+def read_stdin(args):
+    """
+    replace the --stdin flag of the arguments with the standard input
+    of the hook, as the last argument;  after a `--`, so an input
+    starting with `-` isn't parsed as an option
+    """
+    if '--stdin' not in args:
+        return args
+    return [ arg for arg in args if arg != '--stdin' ] + [ '--', sys.stdin.read() ]
+
+def is_safe(directory):
+    """
+    whether the directory is owned by this user (or root) and
+    no one else may write to it
+    """
+    try:
+        status = os.stat(directory)
+    except OSError:
+        return False
+    return status.st_uid in (os.getuid(), 0) and not status.st_mode & 022
+
+def connect(path):
+    """
+    connect to the daemon listening on path;
+    raises socket.error if no daemon is listening, or if the socket
+    could have been made by another user
+    """
+    if not is_safe(os.path.dirname(os.path.abspath(path))):
+        raise socket.error('the directory of %s is writable by others' % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+def send(sock, args):
+    """
+    send the command line arguments to the daemon and wait for the result;
+    returns a tuple of (exit status, output of the hook);
+    raises socket.error if the daemon doesn't answer in full
+    """
+    try:
+        sock.sendall('\0'.join(args))
+        sock.shutdown(socket.SHUT_WR)
+        response = []
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response.append(data)
+    finally:
+        sock.close()
+    response = ''.join(response)
+    if not response.split('\n', 1)[0].isdigit() or '\n' not in response:
+        # e.g. the daemon died while running the hook
+        raise socket.error('no answer from the listener daemon')
+    status, output = response.split('\n', 1)
+    return int(status), output
+
+def main(args=sys.argv[1:]):
+    args = read_stdin(args) # the daemon can't read it
+    parser = option_parser()
+    options, hook_args = parser.parse_args(args)
+
+    if options.coalesce is not None:
+        from repository_hook_system.coalesce import coalesce
+        status = coalesce(options.projects, options.hook, hook_args,
+                          options.coalesce)
+        if status is not None:
+            return status
+
+    sock = None
+    if not [ name for name in pending_environment if name in os.environ ]:
+        try:
+            sock = connect(options.socket)
+        except socket.error:
+            pass
+    if sock is None:
+        # no daemon running, or it couldn't see the changes:
+        # do the work ourselves
+        from repository_hook_system.listener import main
+        return main(args)
+
+    try:
+        status, output = send(sock, args)
+    except socket.error, e:
+        # the hook may have run in part:  don't run it again
+        print >> sys.stderr, 'trac repository hooks: %s' % e
+        return 1
+    sys.stderr.write(output)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+coalescing of bursts of post-commit hooks
+
+When an svnsync mirror catches up, post-commit fires once for every
+synced revision, thousands in a row.  With `--coalesce SECONDS` on the
+hook line, an invocation only extends the range of revisions pending
+for the project, in `<env>/coalesce/<hook>.pending`, and exits at
+once.  svnsync waits for each post-commit to exit before committing
+the next revision, so the invocation getting the lock
+`<env>/coalesce/<hook>.lock` hands it to a process detached from the
+hook, which waits SECONDS for the burst to pile up, then runs the
+subscribers over the pending range, as replay.py does, until no
+revision is left pending.  Its output goes to `<env>/coalesce/<hook>.log`.
+
+This module only imports from the standard library, as the client
+does, so an invocation joining a burst doesn't load trac
+"""
+
+import os
+import sys
+import time
+import traceback
+
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+
+hooks = [ 'post-commit' ] # hooks whose argument is the revision
+
+def filename(project, hook, extension):
+    directory = os.path.join(project, 'coalesce')
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError: # made meanwhile
+            pass
+    return os.path.join(directory, '%s.%s' % (hook, extension))
+
+class PendingRange(object):
+    """the range of revisions waiting for the hook of a project"""
+
+    def __init__(self, project, hook):
+        self.filename = filename(project, hook, 'pending')
+
+    def update(self, change):
+        """
+        replace the range, (start, end) or None, with change(range)
+        under a lock;  returns the former range
+        """
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            flock(fd, LOCK_EX)
+            contents = os.read(fd, 64).split()
+            range = contents and tuple(map(int, contents)) or None
+            new = change(range)
+            os.lseek(fd, 0, 0)
+            os.ftruncate(fd, 0)
+            if new is not None:
+                os.write(fd, '%d %d\n' % new)
+        finally:
+            os.close(fd)
+        return range
+
+    def extend(self, rev):
+        """add the revision to the range"""
+        def change(range):
+            if range is None:
+                return rev, rev
+            return min(range[0], rev), max(range[1], rev)
+        self.update(change)
+
+    def take(self):
+        """empty the range;  returns it, or None if it was empty"""
+        return self.update(lambda range: None)
+
+    def read(self):
+        return self.update(lambda range: range)
+
+class Lock(object):
+    """lock of the invocation running a burst;  released if it dies"""
+
+    def __init__(self, project, hook):
+        self.filename = filename(project, hook, 'lock')
+        self.fd = None
+
+    def acquire(self):
+        """take the lock if no one has it;  returns whether it was taken"""
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        flock(self.fd, LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def hand_over(self):
+        """
+        close the lock without releasing it, for a forked process
+        sharing it to keep
+        """
+        os.close(self.fd)
+        self.fd = None
+
+def detach(log):
+    """
+    fork a process out of the session of the hook, writing to the log
+    rather than the pipes svn waits on;
+    returns True in the detached process, False in the hook
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return False
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    null = os.open(os.devnull, os.O_RDONLY)
+    output = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    os.dup2(null, 0)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+    os.close(null)
+    os.close(output)
+    return True
+
+def run(project, hook, pending):
+    """
+    run the subscribers over the pending ranges until none is left;
+    returns the exit status
+    """
+    from repository_hook_system.replay import Replay
+    status = 0
+    while True:
+        range = pending.take()
+        if range is None:
+            return status
+        replay = Replay(project, hook) # syncs up to the end of the range
+        for rev in replay.revisions(*range):
+            error = replay(rev)
+            if error is not None:
+                print >> sys.stderr, '%s: revision %s failed:\n%s' % (
+                    project, rev, error)
+                status = 1
+
+def burst(project, hook, lock):
+    """
+    run the pending ranges of a project while holding its lock;
+    returns the exit status
+    """
+    pending = PendingRange(project, hook)
+    status = 0
+    while True:
+        try:
+            status = run(project, hook, pending) or status
+        finally:
+            lock.release()
+        # a revision added while the lock was let go would be missed
+        if pending.read() is None or not lock.acquire():
+            return status
+
+def coalesce(projects, hook, args, window):
+    """
+    add the revision of the hook to the pending ranges of the projects,
+    and detach a process running the bursts no other process is running;
+    returns the exit status of the hook, or None if it can't be coalesced
+    """
+    if hook not in hooks or len(args) != 1:
+        return None
+    try:
+        rev = int(args[0])
+    except ValueError:
+        return None
+
+    for project in projects:
+        PendingRange(project, hook).extend(rev)
+
+    locks = [ (project, Lock(project, hook)) for project in projects ]
+    locks = [ (project, lock) for project, lock in locks if lock.acquire() ]
+    if not locks:
+        return 0 # the bursts are being run
+    if not detach(filename(locks[0][0], hook, 'log')):
+        for project, lock in locks:
+            lock.hand_over()
+        return 0
+
+    # the detached process:  never back into the hook's main()
+    status = 0
+    try:
+        time.sleep(window) # let the burst pile up
+        for project, lock in locks:
+            status = burst(project, hook, lock) or status
+    except:
+        traceback.print_exc()
+        status = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status)
@@ -0,0 +1,268 @@
+"""
+single pass parser for ticket commands in commit messages
+
+This replaces the regular expression formerly used by the TicketChanger:
+
+  <opener>(?P<action>[A-Za-z]*).?(?P<ticket>REF(?:(?:[, &]*|[ ]?and[ ]?)REF)*)<closer>
+
+where REF is `(?:#|(?:ticket|issue|bug)[: ]?)[0-9]+`, optionally preceded
+by `project:` for intertrac links.  The regular expression rescans every
+run of letters from each of its positions, which is quadratic on large
+generated messages.  The parser finds the same matches, leftmost first
+and with the same greedy choices, while looking at each character a
+bounded number of times.  (It does not reproduce backtracking into the
+digits of a ticket number, which only matters for closers starting with
+a digit.)  tests/test_commitparser.py compares the two
+"""
+
+import re
+
+from string import ascii_letters
+
+keywords = ('ticket', 'issue', 'bug')
+digits = '0123456789'
+letters = re.compile('[A-Za-z]+')
+
+class CommitMessageParser(object):
+    """finds (action, ticket numbers) commands in commit messages"""
+
+    def __init__(self, projects=(), envelope_open='', envelope_close=''):
+        """
+        * projects : intertrac names one of which must precede ticket
+          references;  if empty, ticket references take no prefix
+        * envelope_open, envelope_close : literals around the commands
+        """
+        self.projects = [ project.lower() for project in projects ]
+        self.envelope_open = envelope_open.lower()
+        self.envelope_close = envelope_close.lower()
+
+        # positions where a ticket reference may start
+        if self.projects:
+            starts = [ re.escape(project + ':') for project in self.projects ]
+        else:
+            starts = [ '#' ] + list(keywords)
+        self.longest = max([ len(start) for start in starts ])
+        # matched on lowered text;  zero width to find overlapping starts
+        self.starts = re.compile('(?=%s)' % '|'.join(starts))
+
+    def parse(self, message):
+        """
+        returns a list of (action, [ticket numbers]) in the order found,
+        as `findall` would for the regular expression
+        """
+        self.text = message.lower()
+        self.message = message
+        self.refs = {} # position -> (end, ticket number) or None
+        self.links = {} # position -> position of the next reference of a list
+        self.ends = {} # position -> end of the longest closed list or None
+        self.inner = {} # end of a run of letters -> last valid start in it
+        self.run = (0, 0) # last run of letters seen
+
+        if self.envelope_open:
+            find = self.find_opener
+        else:
+            find = self.find_action
+        retval = []
+        pos = 0
+        while True:
+            match = find(pos)
+            if match is None:
+                break
+            action, tickets, pos = match
+            retval.append((action, tickets))
+        del self.text, self.message
+        return retval
+
+    ### finding matches
+
+    def find_opener(self, pos):
+        """next match starting with an envelope opener at or after pos"""
+        while True:
+            start = self.text.find(self.envelope_open, pos)
+            if start == -1:
+                return None
+            match = self.match(start + len(self.envelope_open))
+            if match is not None:
+                return match
+            pos = start + 1
+
+    def find_action(self, pos):
+        """next match of an action at or after pos"""
+        text = self.text
+        while True:
+            candidate = self.starts.search(text, pos)
+            if candidate is None:
+                return None
+            c = candidate.start()
+
+            # leftmost start whose action and following character can
+            # lead up to the candidate reference
+            start = self.run_start(c, pos)
+            if start == c and c > pos and text[c-1] != '\n':
+                start = self.run_start(c - 1, pos)
+
+            match = self.match(start)
+            if match is not None:
+                return match
+            end = self.run_end(start)
+            pos = max(end, start) + 1
+
+    def match(self, start):
+        """
+        the match whose action starts at the given position, or None;
+        returns (action, [ticket numbers], end of the match)
+        """
+        text = self.text
+        end = self.run_end(start)
+
+        # the action is the longest run of letters that, with at most one
+        # more character, is followed by a ticket list
+        if end < len(text) and text[end] != '\n' and self.valid(end + 1):
+            target = end + 1
+        elif self.valid(end):
+            target = end
+        else:
+            target = self.last_valid(start, end)
+            if target is None:
+                return None
+
+        action = self.message[start:min(target, end)]
+        tickets = []
+        pos = target
+        last = self.ends[target]
+        while True:
+            ref_end, number = self.refs[pos]
+            tickets.append(number)
+            if ref_end == last:
+                break
+            pos = self.links[pos]
+        return action, tickets, last + len(self.envelope_close)
+
+    ### runs of letters
+
+    def run_end(self, start):
+        """end of the run of letters starting at start"""
+        first, last = self.run
+        if first <= start < last:
+            return last
+        match = letters.match(self.text, start)
+        if match is None:
+            return start
+        self.run = (start, match.end())
+        return match.end()
+
+    def run_start(self, pos, limit):
+        """start of the run of letters ending at pos, not before limit"""
+        text = self.text
+        while pos > limit and text[pos-1] in ascii_letters:
+            pos -= 1
+        return pos
+
+    def last_valid(self, start, end):
+        """last position in [start, end) where a ticket list starts"""
+        if end not in self.inner:
+            # only places where a reference may start need a look
+            candidates = [ candidate.start() for candidate in
+                           self.starts.finditer(self.text, start,
+                                                end + self.longest)
+                           if candidate.start() < end ]
+            candidates.reverse()
+            pos = None
+            for candidate in candidates:
+                if self.valid(candidate):
+                    pos = candidate
+                    break
+            self.inner[end] = pos
+        last = self.inner[end]
+        if last is not None and last >= start:
+            return last
+        return None
+
+    ### ticket references and lists
+
+    def ref(self, pos):
+        """(end, ticket number) of the ticket reference at pos, or None"""
+        if pos in self.refs:
+            return self.refs[pos]
+        text = self.text
+        retval = None
+        if self.projects:
+            for project in self.projects:
+                if text.startswith(project + ':', pos):
+                    retval = self.plain_ref(pos + len(project) + 1)
+                    if retval is not None:
+                        break
+        else:
+            retval = self.plain_ref(pos)
+        self.refs[pos] = retval
+        return retval
+
+    def plain_ref(self, pos):
+        """ticket reference without an intertrac prefix"""
+        text = self.text
+        if text.startswith('#', pos):
+            pos += 1
+        else:
+            for keyword in keywords:
+                if text.startswith(keyword, pos):
+                    pos += len(keyword)
+                    if text[pos:pos+1] in (':', ' '):
+                        pos += 1
+                    break
+            else:
+                return None
+        end = pos
+        while end < len(text) and text[end] in digits:
+            end += 1
+        if end == pos:
+            return None
+        return end, text[pos:end]
+
+    def link(self, end):
+        """start of the reference following a reference ending at end"""
+        text = self.text
+        pos = end
+        while pos < len(text) and text[pos] in ', &':
+            pos += 1
+        if self.ref(pos) is not None:
+            return pos
+        pos = end
+        if text.startswith(' ', pos):
+            pos += 1
+        if text.startswith('and', pos):
+            pos += 3
+            if text.startswith(' ', pos) and self.ref(pos + 1) is not None:
+                return pos + 1
+            if self.ref(pos) is not None:
+                return pos
+        return None
+
+    def valid(self, pos):
+        """
+        whether a ticket list followed by the closer starts at pos;
+        the end of the longest such list is stored in self.ends
+        """
+        if pos in self.ends:
+            return self.ends[pos] is not None
+        if self.ref(pos) is None:
+            self.ends[pos] = None
+            return False
+
+        # follow the list to its end or to a list already seen
+        chain = []
+        while pos is not None and pos not in self.ends:
+            chain.append(pos)
+            link = self.link(self.refs[pos][0])
+            self.links[pos] = link
+            pos = link
+
+        # the longest list is the one whose last closed reference is furthest
+        last = None
+        if pos is not None:
+            last = self.ends[pos]
+        for pos in reversed(chain):
+            end = self.refs[pos][0]
+            if last is None and self.text.startswith(self.envelope_close, end):
+                last = end
+            self.ends[pos] = last
+        return self.ends[chain[0]] is not None
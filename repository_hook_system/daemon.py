@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+long-running listener daemon for the repository hook system
+
+The daemon keeps trac environments, and so the IRepositoryChangeListener
+and IRepositoryHookSubscriber components, loaded between commits.
+The hook scripts talk to it over a unix socket through client.py;
+when the daemon isn't running, the client falls back to listener.py
+
+Each hook invocation is handled in a thread of its own, so a slow
+post-commit doesn't hold up the pre-commits of other repositories
+"""
+
+import os
+import socket
+import sys
+import threading
+import traceback
+
+from optparse import OptionParser
+from repository_hook_system.client import connect
+from repository_hook_system.client import default_socket
+from repository_hook_system.client import is_safe
+from repository_hook_system.interface import IRepositoryChangeListener
+from repository_hook_system.listener import RepositoryChangeListener
+from repository_hook_system.listener import main as listener_main
+from SocketServer import StreamRequestHandler
+from SocketServer import ThreadingUnixStreamServer
+from StringIO import StringIO
+from trac.core import *
+from trac.env import open_environment
+
+class CachedChangeListener(RepositoryChangeListener):
+    """RepositoryChangeListener reusing the environments of the daemon"""
+    use_cache = True
+    # forking while other threads run hooks could leave their locks
+    # held in the children:  --jobs runs the projects one by one here
+    fan_out = False
+
+captured = threading.local() # output of the hook the thread handles
+
+class CapturedOutput(object):
+    """
+    sys.stdout or sys.stderr of the daemon:  what a thread handling a
+    hook writes goes to the output captured for its client
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def target(self):
+        output = getattr(captured, 'output', None)
+        if output is None:
+            return self.stream
+        return output
+
+    def write(self, data):
+        self.target().write(data)
+
+    def writelines(self, lines):
+        self.target().writelines(lines)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class HookRequestHandler(StreamRequestHandler):
+    """
+    runs one hook invocation;  the request is the NUL-separated
+    command line of the client, the response is the exit status
+    on the first line followed by the output of the hook
+    """
+
+    def handle(self):
+        args = self.rfile.read().split('\0')
+
+        # capture the output of the hook for the client
+        output = StringIO()
+        captured.output = output
+        try:
+            try:
+                status = listener_main(args, CachedChangeListener)
+            except SystemExit, e: # bad arguments
+                status = e.code or 0
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            captured.output = None
+
+        self.wfile.write('%s\n%s' % (status, output.getvalue()))
+
+class ListenerDaemon(ThreadingUnixStreamServer):
+    """unix socket server dispatching hook invocations, a thread each"""
+
+    mode = 0660 # mode of the socket
+    daemon_threads = True # a hung hook mustn't keep the daemon alive
+
+    def __init__(self, path=default_socket, projects=()):
+        # the socket lives in a directory only its owner may write to,
+        # so no one else can listen in the daemon's place
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0700)
+        if not is_safe(directory):
+            raise Exception('%s may be written to by other users' % directory)
+        if os.path.exists(path):
+            try:
+                connect(path).close()
+            except socket.error:
+                os.remove(path) # stale socket of a dead daemon
+            else:
+                raise Exception('a daemon is already listening on %s' % path)
+        ThreadingUnixStreamServer.__init__(self, path, HookRequestHandler)
+        os.chmod(path, self.mode)
+
+        if not isinstance(sys.stdout, CapturedOutput):
+            sys.stdout = CapturedOutput(sys.stdout)
+            sys.stderr = CapturedOutput(sys.stderr)
+
+        # warm up the environments
+        for project in projects:
+            self.preload(project)
+
+    def preload(self, project):
+        env = open_environment(project, use_cache=True)
+        ExtensionPoint(IRepositoryChangeListener).extensions(env)
+
+    def server_close(self):
+        ThreadingUnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+def option_parser():
+    parser = OptionParser()
+    parser.add_option('-p', '--project', '--projects',
+                      dest='projects', action='append',
+                      default=[],
+                      help='projects to load on startup')
+    parser.add_option('--socket',
+                      dest='socket', default=default_socket,
+                      help='unix socket to listen on [DEFAULT: %default]')
+    return parser
+
+def main(args=sys.argv[1:]):
+    parser = option_parser()
+    options, args = parser.parse_args(args)
+    daemon = ListenerDaemon(options.socket, options.projects)
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+hook name -> subscribers dispatch for hook systems
+"""
+
+def supports(subscriber, hookname):
+    """
+    whether the subscriber can be used on the hook at all;
+    subscribers may list the hooks they handle in a `hooks` attribute
+    """
+    hooks = getattr(subscriber, 'hooks', None)
+    return hooks is None or hookname in hooks
+
+class DispatchTable(object):
+    """
+    ordered lists of the active subscribers of each hook;
+    the list of a hook is computed once and again only when
+    the subscribers configured for the hook change
+    """
+
+    def __init__(self, listeners, repository):
+        """
+        * listeners : the IRepositoryHookSubscriber extension point
+        * repository : repository types, as passed to is_available
+        """
+        self.listeners = listeners
+        self.repository = repository
+        self.table = {} # hookname -> (configured names, subscribers)
+
+    def subscribers(self, hookname, names):
+        """
+        returns the subscribers named in names that support the hook
+        and are available for it, in the order of names
+        """
+        key = tuple(names)
+        entry = self.table.get(hookname)
+        if entry is None or entry[0] != key:
+            listeners = dict([(listener.__class__.__name__, listener)
+                              for listener in self.listeners
+                              if supports(listener, hookname)])
+            subscribers = [ listeners[name] for name in names
+                            if name in listeners
+                            and listeners[name].is_available(self.repository, hookname) ]
+            entry = self.table[hookname] = (key, subscribers)
+        return entry[1]
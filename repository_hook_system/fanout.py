@@ -0,0 +1,140 @@
+"""
+fan-out of a hook across the projects of a hook line
+
+A repository feeding several trac projects has a `-p` for each of them
+on its hook line.  listener.py runs the projects one after another;
+with `--jobs N`, they are run on a pool of N processes instead, each
+process opening its own environments.  The daemon ignores --jobs:  it
+runs hooks in threads, and forking beside them isn't safe.
+
+The changeset is read once, from the repository rather than a
+project's cache, and handed to the processes, so each project only
+syncs its cache before invoking its subscribers.  Its changes are only
+listed once a subscriber or the routing by paths asks for them, in the
+worker process doing so.  Every project is run whatever the others
+do;  the failures are reported per project
+"""
+
+import sys
+import traceback
+
+from datetime import datetime
+from repository_hook_system.listener import listeners
+from repository_hook_system.runner import HookFailed
+from repository_hook_system.svnchangeset import TransactionChangeset
+from trac.core import *
+from trac.env import open_environment
+from trac.util.datefmt import to_timestamp
+from trac.util.datefmt import utc
+from trac.versioncontrol.api import Changeset
+
+class SharedChangeset(Changeset):
+    """
+    a changeset read once for all the projects of a hook line:  the
+    attributes of trac's Changeset, and its changes once a subscriber
+    or the routing asks for them;  pickles to the worker processes
+    """
+
+    def __init__(self, changeset, repository_dir):
+        Changeset.__init__(self, changeset.rev, changeset.message,
+                           changeset.author, changeset.date)
+        self.changeset = changeset # read the changes from, if asked
+        self.changes = None
+        self.old_message = getattr(changeset, 'old_message', None)
+        self.repository_dir = repository_dir # projects it may be shared with
+
+    def get_changes(self):
+        # a large changeset is only listed if someone looks at it
+        if self.changes is None:
+            self.changes = list(self.changeset.get_changes())
+        return iter(self.changes)
+
+    def __getstate__(self):
+        self.get_changes() # the repository doesn't pickle
+        state = self.__dict__.copy()
+        del state['changeset']
+        if self.date is not None:
+            state['date'] = to_timestamp(self.date) # trac's utc doesn't pickle
+        return state
+
+    def __setstate__(self, state):
+        if state['date'] is not None:
+            state['date'] = datetime.fromtimestamp(state['date'], utc)
+        self.__dict__.update(state)
+
+def read_changeset(listener, project, hook, *args):
+    """
+    the changeset of the hook as read for the project, to share with the
+    other projects;  None if its listener streams changesets of its own
+    """
+    env = open_environment(project, use_cache=listener.use_cache)
+    for repository_listener in listeners(env):
+        if hasattr(repository_listener, 'changesets'):
+            return None
+        try:
+            repo = env.get_repository()
+        except TracError:
+            repo = None
+        repo = getattr(repo, 'repos', repo) # not the project's cache
+        changeset = repository_listener.changeset(repo, hook, *args)
+        if isinstance(changeset, TransactionChangeset):
+            # pickles as it is, keeping its diffs and contents
+            return changeset
+        return SharedChangeset(changeset,
+                               env.config.get('trac', 'repository_dir'))
+    return None
+
+### workers
+
+worker = None # (listener class, hook, arguments) of the worker process
+
+def start_worker(listener, hook, args, shared):
+    global worker
+
+    class FanOutListener(listener):
+        # not the environments of the parent:  their database
+        # connections can't be shared between processes
+        use_cache = False
+
+    FanOutListener.shared = shared
+    worker = (FanOutListener, hook, args)
+
+def run_project(project):
+    """
+    run the hook for a project in a worker;
+    returns the project, exit status and error messages
+    """
+    listener, hook, args = worker
+    try:
+        listener(project, hook, *args)
+    except HookFailed, e:
+        return project, 1, e.messages
+    except Exception:
+        return project, 1, [ traceback.format_exc() ]
+    return project, 0, []
+
+def fan_out(listener, projects, hook, args, jobs):
+    """
+    run the hook for the projects on a pool of jobs processes;
+    returns the exit status
+    """
+    try:
+        shared = read_changeset(listener, projects[0], hook, *args)
+    except Exception:
+        # each project reads it, and reports the failure, on its own
+        shared = None
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(projects)), start_worker,
+                                (listener, hook, args, shared))
+    status = 0
+    try:
+        for project, failed, messages in pool.imap(run_project, projects):
+            if failed:
+                status = 1
+                for message in messages:
+                    print >> sys.stderr, '%s: %s' % (project, message)
+    finally:
+        pool.close()
+        pool.join()
+    return status
@@ -1,11 +1,13 @@
+import inspect
 import os
+import repository_hook_system.client as client
+import repository_hook_system.hookfile as hookfile
 import repository_hook_system.listener as listener
 
 from repository_hook_system.interface import IRepositoryHookSetup
+from repository_hook_system.hookfile import HookFile
 from repository_hook_system.listener import command_line
-from repository_hook_system.listener import option_parser
 from trac.core import *
-from utils import command_line_args
 from utils import iswritable
 
 class FileSystemHooks(Component):
@@ -24,24 +26,40 @@ class FileSystemHooks(Component):
     def filename(self, hookname):
         raise NotImplementedError
 
-    def args(self):
+    def args(self, hookname=None):
         raise NotImplementedError
 
+    def hook_args(self, hookname):
+        """
+        the arguments of the hook line;  args() of providers written
+        before it took the hook name is called without it
+        """
+        spec = inspect.getargspec(self.args)
+        if len(spec[0]) > 1 or spec[1] is not None:
+            return self.args(hookname)
+        return self.args()
+
     ### methods for manipulating the files
 
+    def hook_file(self, hookname):
+        """
+        the parsed HookFile for a given hook,
+        or None if the file does not yet exist
+        """
+        # hook files written before the daemon client existed invoke the
+        # listener directly
+        invokers = [ client.filename(), listener.filename() ]
+        return HookFile.load(self.filename(hookname), self.marker(), invokers)
+
     def file_contents(self, hookname):
         """
         return the lines of the file for a given hook,
         or None if the file does not yet exist
         """ 
-        filename = self.filename(hookname)
-        if not os.path.exists(filename):
+        hook_file = self.hook_file(hookname)
+        if hook_file is None:
             return None
-
-        f = file(filename)
-        retval =  [ i.rstrip() for i in f.readlines() ]
-        f.close()
-        return retval
+        return list(hook_file.lines)
 
     def marker(self):
         """marker to place in the file to identify the hook"""
@@ -50,40 +68,32 @@ class FileSystemHooks(Component):
     def projects_enabled(self, hookname):
         """
         returns enabled projects, or None if the stub is not found
-        returns a tuple of (lines, index, list_of_projects) when found
-        this won't work properly if the command line is used more than once 
-        in the file
+        returns a tuple of (index, lines, list_of_projects) when found
         """
-        lines = self.file_contents(hookname)
-        if lines is None:
+        hook_file = self.hook_file(hookname)
+        if hook_file is None or hook_file.index is None:
             return None
+        return hook_file.index, list(hook_file.lines), list(hook_file.projects)
+
+    def stub(self, hookname):
+        """lines to start a new hook file with"""
+        return [ "#!/bin/bash" ]
 
-        retval = None
-        invoker = listener.filename()
-        for index, line in enumerate(lines):
-            if ' %s ' % invoker in line and not line.strip().startswith('#'):
-                if retval is not None:
-                    # TODO: raise an error indicate that multiple invocations
-                    # detected in the hook file
-                    pass 
-                args = command_line_args(line)
-                parser = option_parser()
-                options, args = parser.parse_args(args)
-                retval = index, lines, options.projects
-
-        return retval
-
-    def create(self, hookname):
-        """create the stub for given hook and return the file object"""
-        
+    def update(self, hookname, change):
+        """
+        change the file for a given hook:  change(hook_file) is called
+        with the current HookFile (or None) and returns the new lines,
+        or None to leave the file alone.  The file is locked for the
+        read-modify-write and replaced atomically
+        """
         filename = self.filename(hookname)
+        lock = hookfile.lock(filename)
         try:
-            os.mknod(filename, self.mode)
-        except: # won't work on windows
-            pass
-        f = file(filename, 'w')
-        print >> f, "#!/bin/bash"
-        return f
+            lines = change(self.hook_file(hookname))
+            if lines is not None:
+                hookfile.write(filename, lines, self.mode)
+        finally:
+            lock.close()
 
     ### methods for IRepositoryHookSetup
 
@@ -96,65 +106,58 @@ class FileSystemHooks(Component):
         if not self.can_enable(hookname):
             return # XXX err more gracefully
 
-        def print_hook(f):
-            print >> f, '%s%s' % (os.linesep, self.marker())
-            print >> f, command_line(self.env.path, hookname, *self.args())
+        def change(hook_file):
+            if hook_file is None:
+                lines = self.stub(hookname)
+            elif hook_file.is_enabled(self.env.path):
+                return None # enabled meanwhile
+            else:
+                lines = list(hook_file.lines)
 
-        filename = self.filename(hookname)
-        if os.path.exists(filename):
-            projects = self.projects_enabled(hookname)
-            if projects is None:            
-                f = file(filename, 'a')
-                print_hook(f)                
+            if hook_file is None or hook_file.index is None:
+                lines.extend(['', self.marker(),
+                              command_line(self.env.path, hookname, *self.hook_args(hookname))])
             else:
-                project = os.path.realpath(self.env.path)
-                index, lines, projects = projects
-                projects.append(project)
-                lines[index] = command_line(projects, hookname, *self.args())
-                f = file(filename, 'w')
-                for line in lines:
-                    print >> f, line                    
-        else:
-            f = self.create(hookname)
-            print_hook(f)
-            
-        f.close()
+                projects = hook_file.projects + [ os.path.realpath(self.env.path) ]
+                lines[hook_file.index] = command_line(projects, hookname,
+                                                      *hook_file.options + self.hook_args(hookname))
+            return lines
+
+        self.update(hookname, change)
 
     def disable(self, hookname):
         if not self.is_enabled(hookname):
             return 
-        index, lines, projects = self.projects_enabled(hookname)
-        projects = [ os.path.realpath(project) 
-                     for project in projects ]
-        project = os.path.realpath(self.env.path)
-        
-        projects.remove(project)
-        if projects:
-            lines[index] = command_line(projects, hookname, *self.args())
-        else:
-            lines.pop(index)
-            # TODO: list bounds checking
-            if lines[index-1] == self.marker():
-                index = index-1
+
+        def change(hook_file):
+            if hook_file is None or not hook_file.is_enabled(self.env.path):
+                return None # disabled meanwhile
+            index = hook_file.index
+            lines = list(hook_file.lines)
+            projects = [ os.path.realpath(project) 
+                         for project in hook_file.projects ]
+            project = os.path.realpath(self.env.path)
+
+            projects.remove(project)
+            if projects:
+                lines[index] = command_line(projects, hookname,
+                                            *hook_file.options + self.hook_args(hookname))
+            else:
                 lines.pop(index)
-            if not lines[index-1].strip():
-                lines.pop(index-1)
-            
-        f = file(self.filename(hookname), 'w')
-        for line in lines:
-            print >> f, line
-        f.close()
+                if hook_file.marker is not None:
+                    index = hook_file.marker
+                    lines.pop(index)
+                if index and not lines[index-1].strip():
+                    lines.pop(index-1)
+            return lines
+
+        self.update(hookname, change)
 
     def is_enabled(self, hookname):
-        if os.path.exists(self.filename(hookname)):
-            projects = self.projects_enabled(hookname)
-            if projects is not None:
-                index, lines, projects = projects
-                projects = [ os.path.realpath(project) for project in projects ]
-                project = os.path.realpath(self.env.path)
-                if project in projects: 
-                    return True
-        return False
+        hook_file = self.hook_file(hookname)
+        return hook_file is not None and hook_file.is_enabled(self.env.path)
 
     def can_enable(self, hookname):
-        return iswritable(self.filename(hookname))
+        # the file is replaced through a temporary file in its directory
+        filename = self.filename(hookname)
+        return iswritable(filename) and os.access(os.path.dirname(filename), os.W_OK)
@@ -0,0 +1,221 @@
+"""
+implementation of the RepositoryChangeListener interface for git
+
+git's pre-receive and post-receive hooks get a line of
+`<old-value> <new-value> <ref-name>` on their standard input for each
+ref updated by a push.  The hook file passes it on with --stdin, and
+the commits of the whole push are walked with one `git rev-list` and
+read from one `git cat-file --batch` process, so the subscribers see
+every changeset of the push in the one environment opened for the hook
+"""
+
+import os
+import subprocess
+
+from datetime import datetime
+from genshi.builder import tag
+from repository_hook_system.dispatch import DispatchTable
+from repository_hook_system.filesystemhooks import FileSystemHooks
+from repository_hook_system.interface import IRepositoryChangeListener
+from repository_hook_system.interface import IRepositoryHookSubscriber
+from repository_hook_system.interface import IRepositoryHookSystem
+from trac.config import ListOption
+from trac.core import *
+from trac.util.datefmt import utc
+from trac.versioncontrol.api import Changeset
+from trac.versioncontrol.api import Node
+from trac.versioncontrol.api import NoSuchChangeset
+
+null = '0' * 40 # the value of a ref that doesn't exist
+
+class GitChangeset(Changeset):
+    """changeset of a git commit, as read from `git cat-file --batch`"""
+
+    actions = { 'A': Changeset.ADD,
+                'C': Changeset.COPY,
+                'D': Changeset.DELETE,
+                'M': Changeset.EDIT,
+                'R': Changeset.MOVE,
+                'T': Changeset.EDIT }
+
+    def __init__(self, repository, rev, data):
+        self.repository = repository
+        self.parents = []
+        headers, message = data.split('\n\n', 1)
+        author = ''
+        date = None
+        for header in headers.splitlines():
+            if header.startswith('parent '):
+                self.parents.append(header.split()[1])
+            elif header.startswith('author '):
+                # author Name <email> timestamp timezone
+                author, timestamp, tz = header[len('author '):].rsplit(' ', 2)
+                date = datetime.fromtimestamp(int(timestamp), utc)
+        Changeset.__init__(self, rev, message, author, date)
+
+    def get_changes(self):
+        """
+        yields (path, kind, change, base_path, base_rev) tuples;
+        one git process per changeset, as only some subscribers ask
+        """
+        output = git(self.repository, 'diff-tree', '-r', '-z', '--root',
+                     '-M', '-C', '--no-commit-id', '--name-status', self.rev)
+        fields = output.split('\0')
+        base_rev = self.parents and self.parents[0] or None
+        index = 0
+        while index < len(fields) - 1:
+            status = fields[index]
+            action = self.actions.get(status[0], Changeset.EDIT)
+            if status[0] in 'CR': # followed by the source and the target
+                base_path, path = fields[index+1], fields[index+2]
+                index += 3
+            else:
+                path = fields[index+1]
+                base_path = action != Changeset.ADD and path or None
+                index += 2
+            yield (path, Node.FILE, action, base_path,
+                   base_path and base_rev or None)
+
+class CatFile(object):
+    """a `git cat-file --batch` process reading the objects of a repository"""
+
+    def __init__(self, repository):
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                        cwd=repository,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+
+    def read(self, sha):
+        """returns (type, contents) of the object"""
+        self.process.stdin.write(sha + '\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3: # <sha> missing
+            raise NoSuchChangeset(sha)
+        sha, type, size = header
+        contents = self.process.stdout.read(int(size))
+        self.process.stdout.read(1) # the newline after the object
+        return type, contents
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def git(repository, *args, **kwargs):
+    """run a git command in the repository;  returns its output"""
+    process = subprocess.Popen(('git',) + args, cwd=repository,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, error = process.communicate(kwargs.get('input'))
+    if process.returncode:
+        raise TracError('git %s failed: %s' % (args[0], error))
+    return output
+
+class GitHookSystem(FileSystemHooks):
+    """implementation of IRepositoryChangeListener for git repositories"""
+
+    implements(IRepositoryHookSystem, IRepositoryChangeListener)
+    listeners = ExtensionPoint(IRepositoryHookSubscriber)
+    hooks = [ 'pre-receive', 'post-receive' ]
+
+    _dispatch = None # DispatchTable of the subscribers
+
+    def repository(self):
+        return self.env.config.get('trac', 'repository_dir')
+
+    ### methods for FileSystemHooks
+
+    def filename(self, hookname):
+        location = self.repository()
+        if os.path.isdir(os.path.join(location, '.git')): # not bare
+            location = os.path.join(location, '.git')
+        return os.path.join(location, 'hooks', hookname)
+
+    def args(self, hookname=None):
+        return [ '--stdin' ]
+
+    ### methods for IRepositoryHookAdminContributer
+
+    def render(self, hookname, req):
+        hook_file = self.hook_file(hookname)
+        if hook_file is not None:
+            return tag.pre(hook_file.contents)
+        return "No %s hook file yet exists;  enable this hook to create one" % hookname
+
+    def process_post(self, hookname, req):
+        pass
+
+    ### methods for IRepositoryChangeListener
+
+    def type(self):
+        return ['git']
+
+    def available_hooks(self):
+        return self.hooks
+
+    def subscribers(self, hookname):
+        """returns the active subscribers for a given hook name"""
+        if self._dispatch is None:
+            self._dispatch = DispatchTable(self.listeners, self.type())
+        self.env.config.parse_if_needed() # pick up changes to trac.ini
+        return self._dispatch.subscribers(hookname, getattr(self, hookname, []))
+
+    def sync(self, repo, hookname, *args):
+        """sync trac's view of the repository, if it has one"""
+        if repo is not None and hookname.startswith('post-'):
+            repo.sync()
+
+    def changeset(self, repo, hookname, commit_id):
+        """the changeset of a single commit"""
+        cat_file = CatFile(self.repository())
+        try:
+            type, data = cat_file.read(commit_id)
+        finally:
+            cat_file.close()
+        if type != 'commit':
+            raise NoSuchChangeset(commit_id)
+        return GitChangeset(self.repository(), commit_id, data)
+
+    def changesets(self, repo, hookname, updates):
+        """
+        yields the changesets of the new commits of a push, oldest first;
+        updates are the lines git passes to the receive hooks
+        """
+        repository = self.repository()
+        updated = {}
+        for line in updates.splitlines():
+            if line.strip():
+                old, new, ref = line.split()
+                updated[ref] = (old, new)
+
+        # new commits:  reachable from the new values, but not from
+        # the old ones or from refs the push leaves alone
+        revisions = []
+        for ref, (old, new) in updated.items():
+            if new != null:
+                revisions.append(new)
+            if old != null:
+                revisions.append('^' + old)
+        if not [ rev for rev in revisions if not rev.startswith('^') ]:
+            return # only deletions
+        refs = git(repository, 'for-each-ref', '--format=%(objectname) %(refname)')
+        for line in refs.splitlines():
+            sha, ref = line.split(' ', 1)
+            if ref not in updated:
+                revisions.append('^' + sha)
+        commits = git(repository, 'rev-list', '--reverse', '--topo-order', '--stdin',
+                      input='\n'.join(revisions) + '\n').split()
+
+        cat_file = CatFile(repository)
+        try:
+            for sha in commits:
+                type, data = cat_file.read(sha)
+                yield GitChangeset(repository, sha, data)
+        finally:
+            cat_file.close()
+
+for hook in GitHookSystem.hooks:
+    setattr(GitHookSystem, hook,
+            ListOption('repository-hooks', hook, default='',
+                       doc="active listeners for git changes on the %s hook" % hook))
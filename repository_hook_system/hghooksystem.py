@@ -0,0 +1,321 @@
+"""
+implementation of the RepositoryChangeListener interface for mercurial
+
+Mercurial runs `python:` hooks inside the hg process, so no interpreter
+is started for a push.  Enabling a hook adds to the hgrc of the
+repository
+
+  [hooks]
+  changegroup.trac = python:repository_hook_system.hghooksystem.hook
+
+  [trac-hooks]
+  changegroup = /path/to/project, /path/to/other/project
+
+The hook runs the listener for each project, handing the subscribers
+every changeset of the incoming changegroup, from the `node` mercurial
+passes to the tip.  On pretxnchangegroup, failing subscribers reject
+the push.  This package and trac must be importable by mercurial
+"""
+
+import os
+
+from datetime import datetime
+from genshi.builder import tag
+from repository_hook_system.dispatch import DispatchTable
+from repository_hook_system.filesystemhooks import FileSystemHooks
+from repository_hook_system.interface import IRepositoryChangeListener
+from repository_hook_system.interface import IRepositoryHookSubscriber
+from repository_hook_system.interface import IRepositoryHookSystem
+from trac.config import ListOption
+from trac.core import *
+from trac.util.datefmt import utc
+from trac.versioncontrol.api import Changeset
+from trac.versioncontrol.api import Node
+from trac.versioncontrol.api import NoSuchChangeset
+
+hook_section = 'hooks'
+projects_section = 'trac-hooks'
+hook_key = '%s.trac' # key of the hook in the [hooks] section
+hook_value = 'python:repository_hook_system.hghooksystem.hook'
+
+repositories = {} # path -> mercurial repository of the running hook
+
+class HgChangeset(Changeset):
+    """changeset of a mercurial changectx"""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        timestamp = ctx.date()[0] # UTC, whatever the offset
+        Changeset.__init__(self, ctx.hex(), ctx.description(), ctx.user(),
+                           datetime.fromtimestamp(timestamp, utc))
+
+    def get_changes(self):
+        """yields (path, kind, change, base_path, base_rev) tuples"""
+        parent = self.ctx.p1()
+        for path in self.ctx.files():
+            if path not in parent:
+                yield path, Node.FILE, Changeset.ADD, None, None
+            elif path not in self.ctx:
+                yield path, Node.FILE, Changeset.DELETE, path, parent.hex()
+            else:
+                yield path, Node.FILE, Changeset.EDIT, path, parent.hex()
+
+class Hgrc(object):
+    """the lines of an hgrc file, edited in place"""
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+
+    def section(self, name):
+        """(start, end) of the lines of a section, or None"""
+        start = None
+        for index, line in enumerate(self.lines):
+            if line.strip().startswith('['):
+                if start is not None:
+                    return start, index
+                if line.strip() == '[%s]' % name:
+                    start = index + 1
+        if start is not None:
+            return start, len(self.lines)
+        return None
+
+    def find(self, section, key):
+        """index of the line setting key in section, or None"""
+        bounds = self.section(section)
+        if bounds is None:
+            return None
+        for index in range(*bounds):
+            line = self.lines[index]
+            if '=' in line and not line.lstrip().startswith(('#', ';')) \
+                    and line.split('=', 1)[0].strip() == key:
+                return index
+        return None
+
+    def get(self, section, key):
+        index = self.find(section, key)
+        if index is None:
+            return None
+        return self.lines[index].split('=', 1)[1].strip()
+
+    def set(self, section, key, value, comment=None):
+        line = '%s = %s' % (key, value)
+        index = self.find(section, key)
+        if index is not None:
+            self.lines[index] = line
+            return
+        bounds = self.section(section)
+        if bounds is None:
+            if self.lines and self.lines[-1].strip():
+                self.lines.append('')
+            self.lines.append('[%s]' % section)
+            bounds = (len(self.lines), len(self.lines))
+        # after the last setting of the section
+        end = bounds[1]
+        while end > bounds[0] and not self.lines[end-1].strip():
+            end -= 1
+        new = [ line ]
+        if comment:
+            new.insert(0, comment)
+        self.lines[end:end] = new
+
+    def remove(self, section, key, comment=None):
+        index = self.find(section, key)
+        if index is None:
+            return
+        self.lines.pop(index)
+        if comment and index and self.lines[index-1] == comment:
+            self.lines.pop(index-1)
+
+        # drop the section if nothing is left in it
+        start, end = self.section(section)
+        if not [ line for line in self.lines[start:end] if line.strip() ]:
+            del self.lines[start-1:end]
+            while self.lines and not self.lines[-1].strip():
+                self.lines.pop()
+
+class HgHookSystem(FileSystemHooks):
+    """implementation of IRepositoryChangeListener for mercurial repositories"""
+
+    implements(IRepositoryHookSystem, IRepositoryChangeListener)
+    listeners = ExtensionPoint(IRepositoryHookSubscriber)
+    hooks = [ 'pretxnchangegroup', 'changegroup' ]
+
+    _dispatch = None # DispatchTable of the subscribers
+
+    def repository(self):
+        return self.env.config.get('trac', 'repository_dir')
+
+    ### methods for FileSystemHooks
+
+    def filename(self, hookname):
+        return os.path.join(self.repository(), '.hg', 'hgrc')
+
+    def args(self, hookname=None):
+        return []
+
+    def stub(self, hookname):
+        return []
+
+    def projects(self, hookname):
+        """the projects the hook is enabled for"""
+        lines = self.file_contents(hookname)
+        if lines is None:
+            return []
+        hgrc = Hgrc(lines)
+        if hgrc.get(hook_section, hook_key % hookname) != hook_value:
+            return []
+        value = hgrc.get(projects_section, hookname) or ''
+        return [ project.strip() for project in value.split(',')
+                 if project.strip() ]
+
+    def projects_enabled(self, hookname):
+        projects = self.projects(hookname)
+        if not projects:
+            return None
+        hgrc = Hgrc(self.file_contents(hookname))
+        return hgrc.find(hook_section, hook_key % hookname), hgrc.lines, projects
+
+    ### methods for IRepositoryHookSetup
+
+    def enable(self, hookname):
+        if self.is_enabled(hookname) or not self.can_enable(hookname):
+            return
+
+        def change(hook_file):
+            hgrc = Hgrc(hook_file is not None and hook_file.lines or [])
+            projects = self.projects(hookname)
+            project = os.path.realpath(self.env.path)
+            if project in projects:
+                return None # enabled meanwhile
+            hgrc.set(hook_section, hook_key % hookname, hook_value,
+                     comment=self.marker())
+            hgrc.set(projects_section, hookname, ', '.join(projects + [ project ]))
+            return hgrc.lines
+
+        self.update(hookname, change)
+
+    def disable(self, hookname):
+        if not self.is_enabled(hookname):
+            return
+
+        def change(hook_file):
+            if hook_file is None:
+                return None
+            hgrc = Hgrc(hook_file.lines)
+            projects = self.projects(hookname)
+            project = os.path.realpath(self.env.path)
+            if project not in projects:
+                return None # disabled meanwhile
+            projects.remove(project)
+            if projects:
+                hgrc.set(projects_section, hookname, ', '.join(projects))
+            else:
+                hgrc.remove(projects_section, hookname)
+                hgrc.remove(hook_section, hook_key % hookname,
+                            comment=self.marker())
+            return hgrc.lines
+
+        self.update(hookname, change)
+
+    def is_enabled(self, hookname):
+        return os.path.realpath(self.env.path) in self.projects(hookname)
+
+    ### methods for IRepositoryHookAdminContributer
+
+    def render(self, hookname, req):
+        hook_file = self.hook_file(hookname)
+        if hook_file is not None:
+            return tag.pre(hook_file.contents)
+        return "No hgrc file yet exists;  enable this hook to create one"
+
+    def process_post(self, hookname, req):
+        pass
+
+    ### methods for IRepositoryChangeListener
+
+    def type(self):
+        return ['hg']
+
+    def available_hooks(self):
+        return self.hooks
+
+    def subscribers(self, hookname):
+        """returns the active subscribers for a given hook name"""
+        if self._dispatch is None:
+            self._dispatch = DispatchTable(self.listeners, self.type())
+        self.env.config.parse_if_needed() # pick up changes to trac.ini
+        return self._dispatch.subscribers(hookname, getattr(self, hookname, []))
+
+    def sync(self, repo, hookname, *args):
+        """sync trac's view of the repository, if it has one"""
+        if repo is not None and not hookname.startswith('pretxn'):
+            repo.sync()
+
+    def hg_repository(self):
+        """
+        the mercurial repository:  the one of the running hook, which
+        sees the incoming changesets before they are committed
+        """
+        path = os.path.realpath(self.repository())
+        if path in repositories:
+            return repositories[path]
+        from mercurial import hg, ui
+        return hg.repository(ui.ui(), path)
+
+    def changeset(self, repo, hookname, node):
+        """the changeset of a single node"""
+        try:
+            return HgChangeset(self.hg_repository()[node])
+        except Exception:
+            raise NoSuchChangeset(node)
+
+    def changesets(self, repo, hookname, node):
+        """yields the changesets from node to the tip, oldest first"""
+        hg_repository = self.hg_repository()
+        for rev in xrange(hg_repository[node].rev(), len(hg_repository)):
+            yield HgChangeset(hg_repository[rev])
+
+for hook in HgHookSystem.hooks:
+    setattr(HgHookSystem, hook,
+            ListOption('repository-hooks', hook, default='',
+                       doc="active listeners for mercurial changes on the %s hook" % hook))
+
+def hook(ui, repo, hooktype, node=None, **kwargs):
+    """
+    the `python:` hook mercurial calls;  returns True on failure,
+    which rejects the changes on pretxnchangegroup
+    """
+    # trac's plugin loading doesn't work with mercurial's lazy imports
+    try:
+        import hgdemandimport as demandimport
+    except ImportError:
+        from mercurial import demandimport
+    enabled = getattr(demandimport, 'isenabled', lambda: True)()
+    demandimport.disable()
+    try:
+        from repository_hook_system.listener import RepositoryChangeListener
+        from repository_hook_system.runner import HookFailed
+
+        class InProcessChangeListener(RepositoryChangeListener):
+            """keeps the environments open between pushes of a server process"""
+            use_cache = True
+
+        path = os.path.realpath(repo.root)
+        repositories[path] = repo
+        failed = False
+        try:
+            for project in ui.configlist(projects_section, hooktype):
+                try:
+                    InProcessChangeListener(project, hooktype, node)
+                except HookFailed, e:
+                    ui.warn('%s\n' % e)
+                    failed = True
+                except Exception, e:
+                    ui.warn('trac hook for %s failed: %s\n' % (project, e))
+                    failed = True
+        finally:
+            del repositories[path]
+    finally:
+        if enabled:
+            demandimport.enable()
+    return failed
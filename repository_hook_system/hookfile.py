@@ -0,0 +1,138 @@
+"""
+parsed model of a hook file, cached while the file is unchanged,
+and safe rewriting of hook files;  tests/test_hookfile_stress.py
+stresses the locking
+"""
+
+import os
+import tempfile
+
+from fcntl import flock, LOCK_EX
+
+from repository_hook_system.client import option_parser
+from utils import command_line_args
+
+class HookFile(object):
+    """
+    a hook file as the hook system sees it:
+    * contents : the text of the file
+    * lines : its lines, stripped of trailing whitespace
+    * index : index of the line invoking the hook system, or None
+    * marker : index of the marker line preceding it, or None
+    * projects : projects on the invocation line
+    * options : the other options of the invocation line to keep when
+      it is rewritten, e.g. --jobs
+    this won't work properly if the command line is used more than once
+    in the file
+    """
+
+    cache = {} # (filename, marker, invokers) -> (stat, HookFile)
+
+    def __init__(self, contents, marker, invokers):
+        self.contents = contents
+        self.lines = [ line.rstrip() for line in contents.splitlines() ]
+        self.index = self.marker = None
+        self.projects = []
+        self.options = []
+
+        for index, line in enumerate(self.lines):
+            if [ invoker for invoker in invokers if ' %s ' % invoker in line ] \
+                    and not line.strip().startswith('#'):
+                if self.index is not None:
+                    # TODO: raise an error indicate that multiple invocations
+                    # detected in the hook file
+                    pass
+                options, args = option_parser().parse_args(command_line_args(line))
+                self.index = index
+                self.projects = options.projects
+                self.options = kept_options(options)
+
+        if self.index and self.lines[self.index - 1] == marker:
+            self.marker = self.index - 1
+
+    def is_enabled(self, project):
+        """whether the project is on the invocation line"""
+        projects = [ os.path.realpath(i) for i in self.projects ]
+        return os.path.realpath(project) in projects
+
+    @classmethod
+    def load(cls, filename, marker, invokers):
+        """
+        returns the HookFile for filename, or None if it does not exist;
+        the file is only parsed again when its inode, size or mtime change
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        stat = (stat.st_ino, stat.st_size, stat.st_mtime)
+        key = (filename, marker, tuple(invokers))
+        cached = cls.cache.get(key)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+
+        f = file(filename)
+        try:
+            hook_file = cls(f.read(), marker, invokers)
+        finally:
+            f.close()
+        cls.cache[key] = (stat, hook_file)
+        return hook_file
+
+    @classmethod
+    def invalidate(cls, filename):
+        """forget the cached models of filename"""
+        for key in cls.cache.keys():
+            if key[0] == filename:
+                cls.cache.pop(key, None)
+
+# options of the invocation line set by hand rather than by the hook
+# system, kept when the line is rewritten
+kept = [ 'socket', 'jobs', 'coalesce' ]
+
+def kept_options(options):
+    """the arguments of the kept options that aren't the defaults"""
+    parser = option_parser()
+    retval = []
+    for option in parser.option_list:
+        if option.dest in kept:
+            value = getattr(options, option.dest)
+            if value != parser.defaults[option.dest]:
+                retval.extend([ option.get_opt_string(), str(value) ])
+    return retval
+
+def lock(filename):
+    """
+    take the advisory lock guarding changes to filename, waiting for it;
+    returns the lock file, to be closed to release the lock.
+    The lock is a separate file as the hook file itself is replaced
+    on each change
+    """
+    directory, name = os.path.split(filename)
+    f = file(os.path.join(directory, '.%s.lock' % name), 'a')
+    flock(f.fileno(), LOCK_EX)
+    return f
+
+def write(filename, lines, mode):
+    """
+    replace the contents of filename with the given lines atomically:
+    a commit running the hook sees either the old or the new file
+    """
+    directory, name = os.path.split(filename)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    try:
+        f = os.fdopen(fd, 'w')
+        for line in lines:
+            print >> f, line
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        if os.path.exists(filename):
+            mode = os.stat(filename).st_mode & 07777
+        os.chmod(tmp, mode)
+        os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    HookFile.invalidate(filename)
@@ -9,7 +9,11 @@ from trac.core import Interface
 
 class IRepositoryHookSubscriber(Interface):
     """
-    interface for subscribers to repository hooks
+    interface for subscribers to repository hooks;
+    a subscriber may list the hooks it handles in a `hooks` class
+    attribute, otherwise it is offered for all hooks;  it may list
+    path patterns in a `paths` class attribute to be invoked only on
+    changesets touching them (see routing.py)
     """
 
     def is_available(repository, hookname):
@@ -32,6 +36,11 @@ class IRepositoryChangeListener(Interface):
     def changeset(repo, hookname, *args):
         """return the changeset as specified by the SCM-specific arguments"""
 
+    # optional:
+    # def sync(repo, hookname, *args):
+    #     """sync the repository cache as far as the hook needs;
+    #     if not implemented, repo.sync() is called"""
+
     def subscribers(hookname): # XXX needed? -> elsewhere?
         """returns activated subscribers for a given hook"""
         # XXX this should probably be moved, as it puts
@@ -0,0 +1,110 @@
+"""
+ledger of the revisions each subscriber has handled
+
+A retried or replayed post-commit hook would otherwise invoke the
+subscribers again for the same revision (e.g. the TicketChanger would
+comment on the tickets twice).  For the hooks in the `ledger-hooks`
+option, a bitmap file per hook and subscriber in the ledger directory
+of the environment has a bit set for each revision handled:  checking a
+revision reads one byte, recording it rewrites one byte under a lock.
+Only integer revisions (as svn has) are kept track of.
+
+The bitmaps are kept per repository, in a directory named by a hash of
+its path and svn uuid file (or directory inode).  Pointing `repository_dir`
+elsewhere, or recreating the repository (e.g. a reloaded svnsync
+mirror), starts new bitmaps rather than skipping the revisions
+numbered as old ones
+"""
+
+import os
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from fcntl import flock, LOCK_EX
+from trac.config import ListOption
+from trac.core import *
+
+class HookLedger(Component):
+    """bitmaps of the (hook, revision) pairs handled by each subscriber"""
+
+    hooks = ListOption('repository-hook-system', 'ledger-hooks', default='post-commit',
+                       doc='hooks whose subscribers are invoked at most once per revision')
+
+    def filename(self, hookname, subscriber):
+        return os.path.join(self.env.path, 'ledger', self.repository(),
+                            '%s.%s' % (hookname, subscriber))
+
+    def repository(self):
+        """
+        name of the ledger directory of the repository;  any change of
+        its path, or of the file of its svn uuid (or else the inode of
+        its directory), starts new bitmaps
+        """
+        directory = os.path.realpath(self.env.config.get('trac', 'repository_dir'))
+        uuid = os.path.join(directory, 'db', 'uuid') # made with an svn repository
+        try:
+            f = file(uuid)
+            try:
+                identity = (f.readline().strip(), os.fstat(f.fileno()).st_ino,
+                            os.fstat(f.fileno()).st_mtime)
+            finally:
+                f.close()
+        except IOError:
+            try:
+                identity = os.stat(directory).st_ino
+            except OSError:
+                identity = None
+        return md5('%s %r' % (directory, identity)).hexdigest()
+
+    def position(self, hookname, rev):
+        """(byte, bit) of the revision in the bitmap, or None if not kept"""
+        if hookname not in self.hooks:
+            return None
+        try:
+            rev = int(rev)
+        except (TypeError, ValueError):
+            return None
+        if rev < 0:
+            return None
+        return rev / 8, rev % 8
+
+    def done(self, hookname, subscriber, rev):
+        """whether the subscriber has handled the revision on the hook"""
+        position = self.position(hookname, rev)
+        if position is None:
+            return False
+        index, bit = position
+        try:
+            fd = os.open(self.filename(hookname, subscriber), os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            os.lseek(fd, index, 0)
+            byte = os.read(fd, 1)
+        finally:
+            os.close(fd)
+        return bool(byte and ord(byte) & (1 << bit))
+
+    def record(self, hookname, subscriber, rev):
+        """note that the subscriber has handled the revision on the hook"""
+        position = self.position(hookname, rev)
+        if position is None:
+            return
+        index, bit = position
+        filename = self.filename(hookname, subscriber)
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            flock(fd, LOCK_EX) # other bits of the byte may be set meanwhile
+            os.lseek(fd, index, 0)
+            byte = os.read(fd, 1)
+            byte = byte and ord(byte) or 0
+            os.lseek(fd, index, 0)
+            os.write(fd, chr(byte | (1 << bit)))
+        finally:
+            os.close(fd)
@@ -8,9 +8,20 @@ from the command line
 
 import os
 import sys
+import traceback
 
-from optparse import OptionParser
+from repository_hook_system import client
+from repository_hook_system.client import option_parser
+from repository_hook_system.client import read_stdin
 from repository_hook_system.interface import IRepositoryChangeListener
+from repository_hook_system.ledger import HookLedger
+from repository_hook_system.metrics import HookMetrics
+from repository_hook_system.metrics import Timings
+from repository_hook_system.routing import PathIndex
+from repository_hook_system.runner import ParallelRunner
+from repository_hook_system.runner import HookFailed
+from repository_hook_system.runner import Rejected
+from repository_hook_system.spool import HookSpool
 from trac.core import *
 from trac.env import open_environment
 from trac.versioncontrol.api import NoSuchChangeset
@@ -18,6 +29,11 @@ from trac.versioncontrol.api import NoSuchChangeset
 class RepositoryChangeListener(object):
     # XXX this doesn't need to be a class...yet!    
 
+    use_cache = False # whether to reuse environments opened before (daemon)
+    spool = True # whether to defer asynchronous hooks to the spool
+    shared = None # changeset read once for the projects of a hook line
+    fan_out = True # whether --jobs may fork a pool (not from a threaded daemon)
+
     def __init__(self, project, hook, *args):
         """
         * project : path to the trac project environment
@@ -25,31 +41,88 @@ class RepositoryChangeListener(object):
         * args : arguments for the particular implementation of IRepositoryChangeListener
         """
 
-        # open the trac environment 
-        env = open_environment(project)
-        repo = env.get_repository() # XXX multiproject branch
-        repo.sync()
+        # time the phases of the hook
+        timings = Timings(hook)
 
-        # find the active listeners
-        listeners = ExtensionPoint(IRepositoryChangeListener).extensions(env)
-        
-        # find the listener for the given repository type and invoke the hook
-        for listener in listeners:
-            if env.config.get('trac', 'repository_type') in listener.type():
-                changeset = listener.changeset(repo, hook, *args)
-                subscribers = listener.subscribers(hook)
+        # open the trac environment 
+        env = timings.call('open', None,
+                           open_environment, project, use_cache=self.use_cache)
+
+        # asynchronous hooks are run later by the spool worker
+        spool = HookSpool(env)
+        if self.spool and spool.is_async(hook):
+            spool.append(hook, *args)
+            return
+
+        try:
+            self.run(env, timings, hook, *args)
+        finally:
+            HookMetrics(env).save(timings)
+
+    def run(self, env, timings, hook, *args):
+        try:
+            repo = env.get_repository() # XXX multiproject branch
+        except TracError:
+            # trac doesn't browse this repository type;  listeners
+            # reading the repository themselves don't need it
+            repo = None
+
+        # invoke the hook with the listeners for the repository type;
+        # revisions a subscriber already handled are skipped
+        ledger = HookLedger(env)
+        runner = ParallelRunner(env)
+        for listener in listeners(env):
+            # listeners may sync only as far as the hook needs
+            if hasattr(listener, 'sync'):
+                timings.call('sync', None, listener.sync, repo, hook, *args)
+            else:
+                timings.call('sync', None, repo.sync)
+
+            # listeners may stream the changesets of a hook covering many
+            if hasattr(listener, 'changesets'):
+                changesets = timings.iterate('changeset', None,
+                                             listener.changesets(repo, hook, *args))
+            elif self.shared is not None and self.shared.repository_dir == \
+                    env.config.get('trac', 'repository_dir'):
+                changesets = [ self.shared ]
+            else:
+                changesets = [ timings.call('changeset', None,
+                                            listener.changeset, repo, hook, *args) ]
+
+            # subscribers with `paths` only see changesets touching them
+            index = PathIndex(listener.subscribers(hook))
+            for changeset in changesets:
+                subscribers = timings.call('route', None, index.route, changeset)
+                if runner.is_parallel(hook):
+                    # the subscribers share the changeset, built once above
+                    runner.run(hook, subscribers, changeset, timings)
+                    continue
                 for subscriber in subscribers:
-                    subscriber.invoke(changeset)
+                    name = subscriber.__class__.__name__
+                    if ledger.done(hook, name, changeset.rev):
+                        continue
+                    timings.call('invoke', name, subscriber.invoke, changeset)
+                    ledger.record(hook, name, changeset.rev)
+
+def listeners(env):
+    """the active IRepositoryChangeListeners for the repository type of env"""
+    repository_type = env.config.get('trac', 'repository_type')
+    return [ listener for listener in
+             ExtensionPoint(IRepositoryChangeListener).extensions(env)
+             if repository_type in listener.type() ]
         
 def filename():
     return os.path.abspath(__file__.rstrip('c'))
 
 def command_line(projects, hook, *args):
-    """return a generic command line for invoking this file"""
+    """
+    return a generic command line for invoking the hook client;
+    the client runs this file's main() when no daemon is listening
+    """
 
     # arguments to the command line
     # XXX this could be returned as a list, if there is a reason to do so
-    retval = [ sys.executable, filename() ]
+    retval = [ sys.executable, client.filename() ]
     
     # enable passing just one argument
     if isinstance(projects, basestring):
@@ -67,27 +140,43 @@ def command_line(projects, hook, *args):
 
     return ' '.join(retval)
 
-def option_parser():
-    parser = OptionParser()
-    parser.add_option('-p', '--project', '--projects', 
-                      dest='projects', action='append', 
-                      default=[],
-                      help='projects to apply to',
-                      )
-    parser.add_option('--hook',
-                      dest='hook',
-                      help='hook called')
-    return parser
-
-if __name__ == '__main__':
+def main(args=sys.argv[1:], listener=RepositoryChangeListener):
 
     # obtain command line options
     # the arguments should be those needed for the particular
     # implementation of IRepositoryChangeListener
     parser = option_parser()
-    options, args = parser.parse_args()
+    options, args = parser.parse_args(read_stdin(args))
 
     # TODO: ensure --hook is passed
 
+    # run the projects of the hook line concurrently
+    if options.jobs > 1 and len(options.projects) > 1 and listener.fan_out:
+        from repository_hook_system.fanout import fan_out
+        return fan_out(listener, options.projects, options.hook, args, options.jobs)
+
+    status = 0
     for project in options.projects:
-        RepositoryChangeListener(project, options.hook, *args)
+        try:
+            listener(project, options.hook, *args)
+        except Rejected, e:
+            # the committer sees the messages of the rejecting subscribers;
+            # the change is refused, no need to ask the other projects
+            print >> sys.stderr, e
+            return 1
+        except HookFailed, e:
+            messages = e.messages
+        except Exception:
+            if options.hook.startswith('pre'):
+                raise
+            messages = [ traceback.format_exc() ]
+        else:
+            continue
+        # the change is in:  the other projects still get it, as with fan_out
+        status = 1
+        for message in messages:
+            print >> sys.stderr, '%s: %s' % (project, message)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
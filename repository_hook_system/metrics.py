@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+latency metrics of the hook system
+
+Each hook invocation records the time spent opening the environment,
+syncing the repository, making the changeset and in each subscriber's
+invoke.  Each invocation appends a line of its timings to the
+`hook-stats.log` file of the trac environment, without taking a lock.
+Once that file is large, it is rotated and folded into the histograms
+of the `hook-stats` file, which is replaced atomically;  the stats are
+the histograms plus the records not folded yet.  Run this file to
+export the stats in the Prometheus text format:
+
+  python metrics.py -p /path/to/project [-p /path/to/other/project]
+"""
+
+import os
+import sys
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from fcntl import flock, LOCK_EX, LOCK_NB
+from optparse import OptionParser
+from trac.config import BoolOption
+from trac.core import *
+
+# upper bounds of the histogram buckets, in seconds;  the last bucket is +Inf
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1., 2.5, 5., 10., 30.)
+
+class Timings(object):
+    """timings of one hook invocation"""
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.records = [] # (phase, subscriber, seconds, error)
+
+    def call(self, phase, subscriber, function, *args, **kwargs):
+        """call function, recording its duration for the phase"""
+        start = time.time()
+        try:
+            retval = function(*args, **kwargs)
+        except:
+            self.records.append((phase, subscriber, time.time() - start, True))
+            raise
+        self.records.append((phase, subscriber, time.time() - start, False))
+        return retval
+
+    def iterate(self, phase, subscriber, iterable):
+        """iterate, recording the time taken by each item for the phase"""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+            except:
+                self.records.append((phase, subscriber, time.time() - start, True))
+                raise
+            self.records.append((phase, subscriber, time.time() - start, False))
+            yield item
+
+class HookMetrics(Component):
+    """stats of the hook latencies of a project"""
+
+    enabled = BoolOption('repository-hook-system', 'metrics', default='true',
+                         doc='record the latencies of hooks and subscribers')
+
+    compact_size = 1048576 # bytes of records past which they are folded
+    quiet = 10 # seconds after which no hook still writes a rotated record file
+
+    def filename(self, suffix=''):
+        return os.path.join(self.env.path, 'hook-stats' + suffix)
+
+    def save(self, timings):
+        """
+        append the timings of an invocation to the records;
+        failing to doesn't fail the hook
+        """
+        if not self.enabled or not timings.records:
+            return
+        try:
+            line = json.dumps([ timings.hook, timings.records ]) + '\n'
+            fd = os.open(self.filename('.log'),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                os.write(fd, line) # one write:  lines of processes don't mix
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+            if size > self.compact_size:
+                self.compact()
+        except Exception, e:
+            self.log.error('HookMetrics: could not save the timings: %s' % e)
+
+    def rotated(self):
+        """names of the record files rotated by compact(), oldest first"""
+        prefix = os.path.basename(self.filename('.log.'))
+        return sorted([ name for name in os.listdir(self.env.path)
+                        if name.startswith(prefix) ])
+
+    def load(self):
+        """returns the folded stats and the names of the record files folded"""
+        try:
+            f = file(self.filename())
+        except IOError:
+            return {}, []
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        try:
+            data = contents and json.loads(contents) or {}
+        except ValueError:
+            self.log.error('HookMetrics: %s is corrupt;  ignoring it'
+                           % self.filename())
+            return {}, []
+        if 'folded' not in data: # the stats of old, without records
+            return data, []
+        return data['stats'], data['folded']
+
+    def fold(self, stats, filename):
+        """add the records of a record file to the stats"""
+        try:
+            f = file(filename)
+        except IOError:
+            return # folded and removed meanwhile
+        try:
+            for line in f:
+                try:
+                    hook, records = json.loads(line)
+                    for phase, subscriber, seconds, error in records:
+                        add(stats, hook, phase, subscriber, seconds, error)
+                except (ValueError, TypeError):
+                    continue # cut short, e.g. by a full disk
+        finally:
+            f.close()
+
+    def compact(self):
+        """
+        fold the records into the stats file, so they needn't be read
+        again;  done by one process at a time, the others go on
+        """
+        lock = file(self.filename('.lock'), 'a')
+        try:
+            try:
+                flock(lock.fileno(), LOCK_EX | LOCK_NB)
+            except IOError:
+                return # another process is on it
+
+            # hooks from now on append to a new record file
+            if os.path.exists(self.filename('.log')):
+                os.rename(self.filename('.log'),
+                          self.filename('.log.%017.6f' % time.time()))
+
+            stats, folded = self.load()
+            removable = folded # folded the time before:  no reader needs them
+            folded = []
+            now = time.time()
+            for name in self.rotated():
+                filename = os.path.join(self.env.path, name)
+                if name in removable:
+                    continue
+                if now - os.stat(filename).st_mtime < self.quiet:
+                    continue # a hook may still be writing it
+                self.fold(stats, filename)
+                folded.append(name)
+
+            # replaced at once:  readers see the old or the new stats
+            tmp = self.filename('.tmp')
+            f = file(tmp, 'w')
+            json.dump(dict(stats=stats, folded=folded), f)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp, self.filename())
+
+            for name in removable:
+                if os.path.exists(os.path.join(self.env.path, name)):
+                    os.remove(os.path.join(self.env.path, name))
+        finally:
+            lock.close()
+
+    def stats(self):
+        """
+        returns a dictionary of (hook, phase, subscriber) -> entry;
+        entries have a count, errors, sum and bucket counts
+        """
+        stats, folded = self.load()
+        try:
+            for name in self.rotated() + [ os.path.basename(self.filename('.log')) ]:
+                if name not in folded:
+                    self.fold(stats, os.path.join(self.env.path, name))
+        except OSError, e:
+            self.log.error('HookMetrics: could not read the records: %s' % e)
+        return dict([(tuple(key.split('|')), entry)
+                     for key, entry in stats.items()])
+
+    def summary(self, hookname):
+        """
+        list of dictionaries with the count, errors and p50/p95/p99 latencies
+        of the phases and subscribers of a hook, for the admin panel
+        """
+        rows = []
+        for (hook, phase, subscriber), entry in sorted(self.stats().items()):
+            if hook != hookname:
+                continue
+            row = dict(phase=phase, subscriber=subscriber,
+                       count=entry['count'], errors=entry['errors'])
+            for q in (50, 95, 99):
+                row['p%d' % q] = percentile(entry['buckets'], q / 100.)
+            rows.append(row)
+        return rows
+
+def add(stats, hook, phase, subscriber, seconds, error):
+    """add a timing to the entry of its key in the stats"""
+    key = '|'.join((hook, phase, subscriber or ''))
+    entry = stats.setdefault(key, dict(count=0, errors=0, sum=0.,
+                                       buckets=[0] * (len(buckets) + 1)))
+    entry['count'] += 1
+    entry['errors'] += int(error)
+    entry['sum'] += seconds
+    for index, bound in enumerate(buckets):
+        if seconds <= bound:
+            break
+    else:
+        index = len(buckets)
+    entry['buckets'][index] += 1
+
+def percentile(counts, q):
+    """
+    estimate the q-quantile (0 < q < 1) from histogram bucket counts,
+    interpolating within the bucket;  returns seconds or None
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = index and buckets[index - 1] or 0.
+            if index == len(buckets):
+                return lower # +Inf bucket:  all we know is the lower bound
+            return lower + (buckets[index] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+def prometheus(project, stats):
+    """
+    the samples of the stats of a project in the Prometheus text
+    exposition format:  lists of the lines of the trac_hook_seconds and
+    of the trac_hook_errors_total families, without their headers
+    """
+    lines = []
+    errors = []
+    for (hook, phase, subscriber), entry in sorted(stats.items()):
+        labels = 'project="%s",hook="%s",phase="%s",subscriber="%s"' % (
+            project, hook, phase, subscriber)
+        cumulative = 0
+        for bound, count in zip(buckets + ('+Inf',), entry['buckets']):
+            cumulative += count
+            lines.append('trac_hook_seconds_bucket{%s,le="%s"} %d'
+                         % (labels, bound, cumulative))
+        lines.append('trac_hook_seconds_sum{%s} %f' % (labels, entry['sum']))
+        lines.append('trac_hook_seconds_count{%s} %d' % (labels, entry['count']))
+        errors.append('trac_hook_errors_total{%s} %d' % (labels, entry['errors']))
+    return lines, errors
+
+def main(args=sys.argv[1:]):
+    from trac.env import open_environment
+
+    parser = OptionParser()
+    parser.add_option('-p', '--project', '--projects',
+                      dest='projects', action='append',
+                      default=[],
+                      help='projects to export the stats of')
+    options, args = parser.parse_args(args)
+
+    # each family is described once, with the samples of all projects
+    lines = [ '# HELP trac_hook_seconds latency of repository hook phases',
+              '# TYPE trac_hook_seconds histogram' ]
+    errors = [ '# HELP trac_hook_errors_total failed repository hook phases',
+               '# TYPE trac_hook_errors_total counter' ]
+    for project in options.projects:
+        env = open_environment(project)
+        name = os.path.basename(os.path.normpath(project))
+        samples, error_samples = prometheus(name, HookMetrics(env).stats())
+        lines.extend(samples)
+        errors.extend(error_samples)
+    sys.stdout.write('\n'.join(lines + errors) + '\n')
+
+if __name__ == '__main__':
+    main()
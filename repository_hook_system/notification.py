@@ -0,0 +1,175 @@
+"""
+pooled, deferred delivery of ticket notifications
+
+Instead of opening an SMTP session per ticket, the TicketChanger queues
+its notifications here.  With `notification-delivery = hook` (the
+default), they are sent over one connection once the changeset is
+done, when `notification-flush-size` notifications are pending, or, if
+`notification-flush-interval` is set, by a background timer of a
+long-running process (the daemon);  a notification that fails to send
+is logged and dropped, as trac does.
+
+With `notification-delivery = spool`, the notifications of a changeset
+are written to the spool of the environment once it is done, and the
+spool worker (`python spool.py`, which has to be running) sends those
+of a batch together over one connection.  A notification that fails to
+send goes back to the spool, which retries it with its backoff and
+dead-letter file.
+
+To try it against a local SMTP stand-in, run
+`python -m smtpd -n -c DebuggingServer localhost:1025` and set
+`smtp_port = 1025` in the [notification] section.
+"""
+
+import atexit
+import threading
+
+from trac.config import IntOption
+from trac.config import Option
+from trac.core import *
+from trac.notification import NotifyEmail
+from trac.ticket.notification import TicketNotifyEmail
+from trac.util.datefmt import to_timestamp
+
+class PooledTicketNotifyEmail(TicketNotifyEmail):
+    """TicketNotifyEmail sending over the connection of a NotificationQueue"""
+
+    def __init__(self, env, queue):
+        TicketNotifyEmail.__init__(self, env)
+        self.queue = queue
+
+    def begin_send(self):
+        self.server = self.queue.connection(self)
+
+    def finish_send(self):
+        pass # the queue closes the connection when it is flushed
+
+class NotificationQueue(Component):
+    """collects ticket notifications to send them over one SMTP session"""
+
+    flush_size = IntOption('repository-hook-system', 'notification-flush-size', default=50,
+                           doc='number of queued notifications that triggers sending them')
+    flush_interval = IntOption('repository-hook-system', 'notification-flush-interval', default=0,
+                               doc='seconds notifications may wait in a long-running process; if 0, they are sent at the end of each changeset')
+    delivery = Option('repository-hook-system', 'notification-delivery', default='hook',
+                      doc='"hook" to send the notifications of hooks from the process running the hook, "spool" to have the spool worker (spool.py) send and retry them')
+
+    def __init__(self):
+        self.pending = [] # (ticket, modtime, spool event or None)
+        self.server = None
+        self.timer = None
+        self.lock = threading.RLock()
+        self.exit_registered = False
+
+    def enqueue(self, ticket, modtime, event=None):
+        """
+        queue a notification for a changed ticket;
+        event is the name of the spool event it comes from, if any
+        """
+        self.lock.acquire()
+        try:
+            self.pending.append((ticket, modtime, event))
+            size = len(self.pending)
+        finally:
+            self.lock.release()
+        if event is not None:
+            return # the spool flushes its batch
+        if self.delivery == 'spool':
+            if size >= self.flush_size:
+                self.spool()
+        elif size >= self.flush_size:
+            self.flush()
+        elif self.flush_interval:
+            self.schedule()
+
+    def changeset_done(self):
+        """called at the end of a changeset"""
+        if self.delivery == 'spool':
+            self.spool()
+        elif not self.flush_interval:
+            self.flush()
+
+    def spool(self):
+        """hand the pending notifications to the spool worker"""
+        from repository_hook_system.spool import HookSpool # it imports us
+        self.lock.acquire()
+        try:
+            spool = HookSpool(self.env)
+            pending, self.pending = self.pending, []
+            for item in pending:
+                ticket, modtime, event = item
+                if event is not None:
+                    self.pending.append(item) # spooled already
+                    continue
+                spool.append('notify', ticket.id, to_timestamp(modtime))
+        finally:
+            self.lock.release()
+
+    def schedule(self):
+        """send the pending notifications after the flush interval"""
+        self.lock.acquire()
+        try:
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.setDaemon(True)
+                self.timer.start()
+            if not self.exit_registered:
+                atexit.register(self.shutdown)
+                self.exit_registered = True
+        finally:
+            self.lock.release()
+
+    def connection(self, notifier):
+        """the SMTP connection, opened with the settings of the notifier"""
+        if self.server is None:
+            NotifyEmail.begin_send(notifier)
+            self.server = notifier.server
+        return self.server
+
+    def flush(self):
+        """
+        send all pending notifications over one connection;
+        returns the (spool event, error) of the spooled ones that failed,
+        for the spool to retry
+        """
+        self.lock.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, []
+            failed = []
+            for ticket, modtime, event in pending:
+                try:
+                    tn = PooledTicketNotifyEmail(self.env, self)
+                    tn.notify(ticket, newticket=0, modtime=modtime)
+                except Exception, e:
+                    self.env.log.error('NotificationQueue: failure sending '
+                                       'notification on ticket #%s: %s'
+                                       % (ticket.id, repr(e)))
+                    self.close() # start over with a new connection
+                    if event is not None:
+                        failed.append((event, repr(e)))
+                    elif self.delivery == 'spool':
+                        self.pending.append((ticket, modtime, None))
+            self.close()
+            if self.pending:
+                self.spool() # the spool retries the failed ones
+            return failed
+        finally:
+            self.lock.release()
+
+    def shutdown(self):
+        """don't lose pending mail when the process exits"""
+        if self.delivery == 'spool':
+            self.spool()
+        else:
+            self.flush()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
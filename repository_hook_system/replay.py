@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""
+replay of a hook over a range of revisions
+
+Re-runs the subscribers of a post-type hook for revisions already
+committed, e.g. after an outage or a misconfigured subscriber:
+
+  python replay.py -p /path/to/project --hook post-commit -r 1200:HEAD
+
+The environment and repository are opened once (once per worker with
+--workers).  Progress is checkpointed in the `replay-checkpoint` file
+of the environment;  running the same replay again resumes after the
+last revision done, unless --restart is given.  Revisions the ledger
+has as handled by a subscriber are skipped for it, unless --force is
+given
+"""
+
+import os
+import sys
+import time
+import traceback
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from optparse import OptionParser
+from repository_hook_system.ledger import HookLedger
+from repository_hook_system.listener import listeners
+from repository_hook_system.routing import PathIndex
+from trac.env import open_environment
+
+class Replay(object):
+    """runs the subscribers of a hook on changesets of one repository"""
+
+    def __init__(self, project, hook, use_cache=True, force=False):
+        self.env = open_environment(project, use_cache=use_cache)
+        self.hook = hook
+        self.force = force # whether to invoke subscribers on handled revisions
+        self.ledger = HookLedger(self.env)
+        self.repo = self.env.get_repository()
+        self.repo.sync()
+        self.listeners = listeners(self.env)
+
+    def revisions(self, start, end):
+        """the revisions from start to end, inclusive, oldest first"""
+        start = self.repo.normalize_rev(start)
+        end = self.repo.normalize_rev(end)
+        rev = start
+        while rev is not None:
+            yield rev
+            if rev == end:
+                break
+            rev = self.repo.next_rev(rev)
+
+    def __call__(self, rev):
+        """replay one revision;  returns the error, if any"""
+        try:
+            for listener in self.listeners:
+                changeset = listener.changeset(self.repo, self.hook, rev)
+                index = PathIndex(listener.subscribers(self.hook))
+                for subscriber in index.route(changeset):
+                    name = subscriber.__class__.__name__
+                    if not self.force and self.ledger.done(self.hook, name, rev):
+                        continue
+                    subscriber.invoke(changeset)
+                    self.ledger.record(self.hook, name, rev)
+        except Exception:
+            error = traceback.format_exc()
+            self.env.log.error('Replay: %s of revision %s failed: %s'
+                               % (self.hook, rev, error))
+            return error
+
+class Checkpoint(object):
+    """progress of a replay, kept in the environment"""
+
+    def __init__(self, env, hook, start, end):
+        self.filename = os.path.join(env.path, 'replay-checkpoint')
+        self.key = dict(hook=hook, start=str(start), end=str(end))
+        self.done = None # last revision replayed, all before it being done
+        self.failed = [] # revisions whose replay failed
+
+    def load(self):
+        """read the checkpoint of the same replay, if any"""
+        try:
+            f = file(self.filename)
+        except IOError:
+            return
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        if state.get('replay') == self.key:
+            self.done = state['done']
+            self.failed = state['failed']
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        f = file(tmp, 'w')
+        json.dump(dict(replay=self.key, done=self.done, failed=self.failed), f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, self.filename)
+
+### workers
+
+worker = None # Replay of the worker process
+
+def start_worker(project, hook, force):
+    global worker
+    # not the environment inherited from the parent:  its database
+    # connections can't be shared between processes
+    worker = Replay(project, hook, use_cache=False, force=force)
+
+def replay_chunk(revisions):
+    """
+    replay revisions in a worker;
+    returns the revisions and the (rev, error) of failures
+    """
+    failures = []
+    for rev in revisions:
+        error = worker(rev)
+        if error is not None:
+            failures.append((rev, error))
+    return revisions, failures
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+### command line
+
+def option_parser():
+    parser = OptionParser()
+    parser.add_option('-p', '--project', dest='project',
+                      help='project to replay the hook of')
+    parser.add_option('--hook', dest='hook', default='post-commit',
+                      help='hook to replay [DEFAULT: %default]')
+    parser.add_option('-r', '--revisions', dest='revisions',
+                      help='revision range START:END;  END may be HEAD')
+    parser.add_option('-j', '--workers', dest='workers', type='int', default=1,
+                      help='number of worker processes [DEFAULT: %default]')
+    parser.add_option('--chunk-size', dest='chunk_size', type='int', default=50,
+                      help='revisions handed to a worker at once and between checkpoints [DEFAULT: %default]')
+    parser.add_option('--restart', dest='restart', action='store_true', default=False,
+                      help='ignore the checkpoint of an earlier run')
+    parser.add_option('--force', dest='force', action='store_true', default=False,
+                      help='invoke subscribers on revisions the ledger has as handled')
+    return parser
+
+def main(args=sys.argv[1:]):
+    global worker
+    parser = option_parser()
+    options, args = parser.parse_args(args)
+    if not options.project or not options.revisions or ':' not in options.revisions:
+        parser.error('a project and a START:END revision range are required')
+    if not options.hook.startswith('post-'):
+        parser.error('only post-type hooks can be replayed')
+    start, end = options.revisions.split(':', 1)
+    if end.upper() == 'HEAD':
+        end = None # youngest revision
+
+    replay = Replay(options.project, options.hook, force=options.force)
+    start = replay.repo.normalize_rev(start)
+    end = replay.repo.normalize_rev(end)
+    if replay.repo.rev_older_than(end, start):
+        # revisions() would walk from start to the youngest revision
+        parser.error('the revision range %s:%s is reversed' % (start, end))
+    checkpoint = Checkpoint(replay.env, options.hook, start, end)
+    if not options.restart:
+        checkpoint.load()
+    if checkpoint.done is not None:
+        if str(checkpoint.done) == str(end):
+            print 'replay of %s:%s already done' % (start, end)
+            return checkpoint.failed and 1 or 0
+        start = replay.repo.next_rev(checkpoint.done)
+        print 'resuming after revision %s' % checkpoint.done
+
+    revisions = chunks(replay.revisions(start, end), options.chunk_size)
+    if options.workers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(options.workers, start_worker,
+                                    (options.project, options.hook, options.force))
+        results = pool.imap(replay_chunk, revisions) # in order
+    else:
+        pool = None
+        worker = replay
+        results = (replay_chunk(chunk) for chunk in revisions)
+
+    # imap yields chunks in order, so a checkpoint never skips a revision
+    count = 0
+    began = time.time()
+    try:
+        for chunk, failures in results:
+            checkpoint.done = chunk[-1]
+            checkpoint.failed.extend([ rev for rev, error in failures ])
+            checkpoint.save()
+            for rev, error in failures:
+                print >> sys.stderr, 'revision %s failed:\n%s' % (rev, error)
+            count += len(chunk)
+            elapsed = time.time() - began
+            print 'revision %s: %d revisions in %.1fs (%.1f/s)' % (
+                chunk[-1], count, elapsed, count / max(elapsed, 1e-6))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if checkpoint.failed:
+        print >> sys.stderr, 'failed revisions: %s' % ', '.join(map(str, checkpoint.failed))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
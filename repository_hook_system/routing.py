@@ -0,0 +1,117 @@
+"""
+routing of changesets to subscribers by the paths they change
+
+A subscriber may list the paths it cares about in a `paths` class
+attribute, e.g.
+
+  paths = [ '/trunk/docs/**', '/branches/*/docs/' ]
+
+and is then invoked only on changesets touching a matching path.
+`*` and `?` match within a path segment, `**` matches any number of
+segments and a trailing `/` is short for `/**`.  Subscribers without
+`paths` are invoked on every changeset.
+
+The changed paths of a changeset are read once, and each is looked up
+in a trie of the literal leading segments of the patterns, so only the
+patterns sharing a path's prefix are matched against it
+"""
+
+from fnmatch import fnmatchcase
+from trac.versioncontrol.api import Changeset
+from trac.versioncontrol.api import Node
+
+def segments(path):
+    """the segments of a path, without empty ones"""
+    return [ segment for segment in path.split('/') if segment ]
+
+def pattern_segments(pattern):
+    """the segments of a pattern, with the trailing `/` made explicit"""
+    retval = segments(pattern)
+    if pattern.endswith('/') and retval[-1:] != ['**']:
+        retval.append('**')
+    return retval
+
+def is_literal(segment):
+    return not [ char for char in '*?[' if char in segment ]
+
+def match(pattern, path, prefix=False):
+    """
+    whether the path segments match the pattern segments;
+    with prefix, a path matches if something below it could
+    """
+    if not pattern:
+        return not path
+    if pattern[0] == '**':
+        # none, or one more segment, matched by the **
+        if match(pattern[1:], path, prefix):
+            return True
+        return bool(path) and match(pattern, path[1:], prefix)
+    if not path:
+        return prefix
+    return fnmatchcase(path[0], pattern[0]) and \
+        match(pattern[1:], path[1:], prefix)
+
+class PathIndex(object):
+    """
+    prefix trie of the `paths` of a list of subscribers;
+    routes a changeset to the subscribers it concerns
+    """
+
+    def __init__(self, subscribers):
+        self.subscribers = subscribers
+        self.routed = set() # names of the subscribers with paths
+        self.root = ({}, []) # (segment -> child, [(rest of pattern, name)])
+        for subscriber in subscribers:
+            paths = getattr(subscriber, 'paths', None)
+            if paths is None:
+                continue
+            name = subscriber.__class__.__name__
+            self.routed.add(name)
+            for pattern in paths:
+                pattern = pattern_segments(pattern)
+                node = self.root
+                while pattern and is_literal(pattern[0]):
+                    node = node[0].setdefault(pattern[0], ({}, []))
+                    pattern = pattern[1:]
+                node[1].append((pattern, name))
+
+    def matches(self, path, prefix=False):
+        """names of the subscribers with a pattern matching the path"""
+        path = segments(path)
+        names = set()
+        node = self.root
+        depth = 0
+        while True:
+            for pattern, name in node[1]:
+                if name not in names and match(pattern, path[depth:], prefix):
+                    names.add(name)
+            if depth == len(path) or path[depth] not in node[0]:
+                break
+            node = node[0][path[depth]]
+            depth += 1
+        if prefix and depth == len(path):
+            # the path is a directory above the literal part of patterns
+            nodes = node[0].values()
+            while nodes:
+                node = nodes.pop()
+                names.update([ name for pattern, name in node[1] ])
+                nodes.extend(node[0].values())
+        return names
+
+    def route(self, changeset):
+        """the subscribers to invoke on the changeset, in order"""
+        if not self.routed:
+            return self.subscribers
+        names = set()
+        for path, kind, change, base_path, base_rev in changeset.get_changes():
+            # adding, copying, moving or deleting a directory
+            # changes everything below it
+            prefix = kind == Node.DIRECTORY and change != Changeset.EDIT
+            for path in path, base_path:
+                if path is not None:
+                    names.update(self.matches(path, prefix))
+            if names == self.routed:
+                break
+        return [ subscriber for subscriber in self.subscribers
+                 if subscriber.__class__.__name__ in names
+                 or subscriber.__class__.__name__ not in self.routed ]
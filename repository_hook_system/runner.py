@@ -0,0 +1,214 @@
+"""
+concurrent invocation of the subscribers of a hook
+
+For the hooks listed in the `parallel-hooks` option, the subscribers
+are invoked concurrently on the one changeset built for the hook.
+
+Pre-type hook subscribers validate a transaction while the committer
+waits.  They are invoked at once, each in its own thread.  A subscriber
+rejects the transaction by raising an exception;  the first rejection
+(or a subscriber running past its timeout or the deadline of the hook)
+fails the hook without waiting for the others.
+
+Post-type hook subscribers run on a pool of `parallel-workers` threads,
+each thread with its own database connection.  A failing subscriber
+has its uncommitted changes rolled back and doesn't stop the others;
+the failures are reported once all subscribers are done.  A subscriber
+listing other subscribers' names in an `after` class attribute is
+started once those are done
+"""
+
+import threading
+import time
+import traceback
+
+from Queue import Empty
+from Queue import Queue
+from repository_hook_system.ledger import HookLedger
+from trac.config import IntOption
+from trac.config import ListOption
+from trac.config import Option
+from trac.core import *
+
+class HookFailed(Exception):
+    """subscribers of a hook failed"""
+
+    def __init__(self, messages):
+        Exception.__init__(self, '\n'.join(messages))
+        self.messages = messages
+
+class Rejected(HookFailed):
+    """the subscribers of a pre-type hook rejected the changes"""
+
+class ParallelRunner(Component):
+    """invokes the subscribers of a hook concurrently"""
+
+    hooks = ListOption('repository-hook-system', 'parallel-hooks', default='',
+                       doc='hooks whose subscribers are invoked concurrently')
+    workers = IntOption('repository-hook-system', 'parallel-workers', default=4,
+                        doc='threads invoking the subscribers of a concurrent post-type hook')
+    deadline = Option('repository-hook-system', 'parallel-deadline', default='30',
+                      doc='seconds all subscribers of a concurrent hook must finish in')
+    timeout = Option('repository-hook-system', 'subscriber-timeout', default='10',
+                     doc="seconds a subscriber of a concurrent hook may take, unless it has a `timeout` attribute")
+
+    def is_parallel(self, hookname):
+        """whether the subscribers of the hook are invoked concurrently"""
+        return hookname in self.hooks
+
+    def run(self, hookname, subscribers, changeset, timings):
+        """
+        invoke the subscribers on the changeset, recording their timings;
+        raises HookFailed if any fail
+        """
+        if hookname.startswith('pre-'):
+            self.validate(hookname, subscribers, changeset, timings)
+        else:
+            self.isolate(hookname, subscribers, changeset, timings)
+
+    ### pre-type hooks
+
+    def validate(self, hookname, subscribers, changeset, timings):
+        """
+        invoke all subscribers at once;
+        raises Rejected on the first rejection or timeout
+        """
+        results = Queue() # (name, error message or None)
+        start = time.time()
+        deadline = start + float(self.deadline)
+        expiries = {} # name -> time the subscriber must be done by
+        for subscriber in subscribers:
+            name = subscriber.__class__.__name__
+            timeout = float(getattr(subscriber, 'timeout', None) or self.timeout)
+            expiries[name] = min(start + timeout, deadline)
+            thread = threading.Thread(target=self.invoke,
+                                      args=(results, timings, subscriber, changeset))
+            thread.setDaemon(True) # a hung subscriber mustn't keep the hook alive
+            thread.start()
+
+        while expiries:
+            now = time.time()
+            expired = [ name for name, expiry in expiries.items() if expiry <= now ]
+            if expired:
+                messages = []
+                for name in sorted(expired):
+                    timings.records.append(('invoke', name, now - start, True))
+                    messages.append('%s: no answer within %.1f seconds'
+                                    % (name, expiries[name] - start))
+                self.log.error('ParallelRunner: %s timed out on %s'
+                               % (', '.join(expired), hookname))
+                raise Rejected(messages)
+            try:
+                name, error = results.get(timeout=min(expiries.values()) - now)
+            except Empty:
+                continue
+            del expiries[name]
+            if error is not None:
+                # fail fast, with the rejections already in
+                messages = [ '%s: %s' % (name, error) ]
+                while True:
+                    try:
+                        name, error = results.get_nowait()
+                    except Empty:
+                        break
+                    if error is not None:
+                        messages.append('%s: %s' % (name, error))
+                raise Rejected(messages)
+
+    def invoke(self, results, timings, subscriber, changeset):
+        """thread invoking a pre-type hook subscriber"""
+        name = subscriber.__class__.__name__
+        try:
+            timings.call('invoke', name, subscriber.invoke, changeset)
+        except Exception, e:
+            self.log.error('ParallelRunner: %s rejected the changes: %s'
+                           % (name, traceback.format_exc()))
+            results.put((name, str(e) or e.__class__.__name__))
+        else:
+            results.put((name, None))
+
+    ### post-type hooks
+
+    def isolate(self, hookname, subscribers, changeset, timings):
+        """
+        invoke the subscribers on the worker pool, in the order of their
+        `after` constraints;  raises HookFailed once all are done if any
+        of them failed
+        """
+        order = [ subscriber.__class__.__name__ for subscriber in subscribers ]
+        subscribers = dict(zip(order, subscribers))
+        waiting = dict([ (name, set(getattr(subscriber, 'after', [])) & set(subscribers))
+                         for name, subscriber in subscribers.items() ])
+        ready = Queue() # names to invoke, or None to stop
+        done = Queue() # (name, error or None)
+        ledger = HookLedger(self.env)
+
+        def worker():
+            while True:
+                name = ready.get()
+                if name is None:
+                    return
+                try:
+                    error = self.invoke_isolated(hookname, subscribers[name],
+                                                 changeset, timings, ledger)
+                except Exception, e: # e.g. from the ledger;  keep the worker
+                    error = str(e) or e.__class__.__name__
+                done.put((name, error))
+
+        threads = []
+        for index in range(min(self.workers, len(subscribers))):
+            thread = threading.Thread(target=worker)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        failures = []
+        running = 0
+        try:
+            while waiting or running:
+                startable = [ name for name in order
+                              if name in waiting and not waiting[name] ]
+                if not startable and not running:
+                    # the rest wait on each other:  run them anyway
+                    self.log.error('ParallelRunner: circular `after` constraints '
+                                   'between %s' % ', '.join(sorted(waiting)))
+                    startable = [ name for name in order if name in waiting ]
+                for name in startable:
+                    del waiting[name]
+                    ready.put(name)
+                    running += 1
+                name, error = done.get()
+                running -= 1
+                for names in waiting.values():
+                    names.discard(name)
+                if error is not None:
+                    failures.append('%s: %s' % (name, error))
+        finally:
+            for thread in threads:
+                ready.put(None)
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise HookFailed(failures)
+
+    def invoke_isolated(self, hookname, subscriber, changeset, timings, ledger):
+        """
+        invoke a post-type hook subscriber in a worker thread;
+        returns the error message if it fails
+        """
+        name = subscriber.__class__.__name__
+        if ledger.done(hookname, name, changeset.rev):
+            return None
+        try:
+            timings.call('invoke', name, subscriber.invoke, changeset)
+        except Exception, e:
+            self.log.error('ParallelRunner: %s failed on %s: %s'
+                           % (name, hookname, traceback.format_exc()))
+            try:
+                # the database connection is this thread's own
+                self.env.get_db_cnx().rollback()
+            except Exception:
+                pass
+            return str(e) or e.__class__.__name__
+        ledger.record(hookname, name, changeset.rev)
+        return None
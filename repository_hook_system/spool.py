@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+durable spool for asynchronous hooks
+
+For the hooks listed in the `async-hooks` option, the hook only appends
+an event to the spool directory of the trac environment and returns.
+A worker (`python spool.py -p /path/to/project`) drains the spool in
+batches, retrying failed events with an exponential backoff and moving
+permanently failed events to the dead-letter file.
+
+Ticket notifications are spooled as `notify` events (see
+notification.py);  those of a batch are sent over one SMTP connection.
+
+An event file is named after the time it is next due, so the events
+to run are the first ones of the sorted listing of the spool, found
+without opening any
+"""
+
+import os
+import sys
+import time
+import traceback
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from datetime import datetime
+from fcntl import flock, LOCK_EX, LOCK_NB
+from optparse import OptionParser
+from repository_hook_system.notification import NotificationQueue
+from trac.config import IntOption
+from trac.config import ListOption
+from trac.core import *
+from trac.ticket import Ticket
+from trac.util.datefmt import utc
+
+class HookSpool(Component):
+    """on-disk queue of hook events to be run outside of the hook"""
+
+    async_hooks = ListOption('repository-hook-system', 'async-hooks', default='',
+                             doc='post-type hooks whose subscribers run from the spool instead of in the hook')
+    batch_size = IntOption('repository-hook-system', 'spool-batch-size', default=20,
+                           doc='number of spooled events handled per batch')
+    max_attempts = IntOption('repository-hook-system', 'spool-max-attempts', default=5,
+                             doc='attempts before a spooled event goes to the dead-letter file')
+    retry_delay = IntOption('repository-hook-system', 'spool-retry-delay', default=60,
+                            doc='seconds before retrying a failed event; doubled on each attempt')
+
+    counter = 0 # distinguishes events appended in the same instant
+
+    def directory(self, *path):
+        return os.path.join(self.env.path, 'spool', *path)
+
+    def is_async(self, hookname):
+        """whether the hook should be deferred to the spool"""
+        # only the outcome of pre-type hooks matters to the committer
+        return hookname.startswith('post-') and hookname in self.async_hooks
+
+    ### writing events
+
+    def write(self, name, event):
+        """atomically (re)write the event of the given name"""
+        tmp = self.directory('tmp')
+        if not os.path.exists(tmp):
+            os.makedirs(tmp)
+        filename = os.path.join(tmp, name)
+        f = file(filename, 'w')
+        json.dump(event, f)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(filename, self.directory(name))
+
+    def name(self, due):
+        """a new name for an event due at the given time"""
+        HookSpool.counter += 1
+        return '%017.6f-%d-%d.event' % (due, os.getpid(), HookSpool.counter)
+
+    def due(self, name):
+        """the time the event of the given name is due"""
+        return float(name.split('-', 1)[0])
+
+    def append(self, hookname, *args):
+        """add an event for the hook to the spool"""
+        now = time.time()
+        self.write(self.name(now), dict(hook=hookname, args=list(args),
+                                        created=now, attempts=0, next_attempt=now))
+
+    ### draining events
+
+    def ready(self):
+        """names of the events due to be run, oldest first"""
+        directory = self.directory()
+        if not os.path.exists(directory):
+            return []
+        now = time.time()
+        retval = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.event'):
+                continue
+            if self.due(name) > now:
+                break # so are all the ones after it
+            retval.append(name)
+        return retval
+
+    def read(self, name):
+        try:
+            f = file(self.directory(name))
+        except IOError:
+            return None # already handled
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def lock(self):
+        """
+        take the worker lock of the spool;
+        returns the lock file, or None if another worker has it
+        """
+        directory = self.directory()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        f = file(self.directory('lock'), 'w')
+        try:
+            flock(f.fileno(), LOCK_EX | LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+        return f
+
+    def drain(self, process):
+        """
+        call process(hookname, *args) for the ready events of the spool,
+        a batch at a time;  returns the number of events handled
+        """
+        lock = self.lock()
+        if lock is None:
+            return 0 # another worker is on it
+        count = 0
+        try:
+            while True:
+                # the spool is listed again only for the events
+                # appended while the ready ones ran
+                ready = self.ready()
+                if not ready:
+                    break
+                for index in range(0, len(ready), self.batch_size):
+                    batch = ready[index:index+self.batch_size]
+                    notifications = [ name for name in batch
+                                      if self.run(name, process) ]
+                    count += len(batch)
+                    self.notify(notifications) # one SMTP session per batch
+        finally:
+            lock.close()
+        return count
+
+    def run(self, name, process):
+        """
+        run a single event, rescheduling or burying it on failure;
+        returns whether it is a notification, to be sent with the batch
+        """
+        event = self.read(name)
+        if event is None:
+            return False # already handled
+        try:
+            if event['hook'] == 'notify':
+                ticket_id, modtime = event['args']
+                NotificationQueue(self.env).enqueue(
+                    Ticket(self.env, ticket_id),
+                    datetime.fromtimestamp(modtime, utc), name)
+                return True
+            process(event['hook'], *event['args'])
+        except Exception:
+            self.fail(name, event, traceback.format_exc())
+        else:
+            os.remove(self.directory(name))
+        return False
+
+    def notify(self, names):
+        """send the queued notifications of the events of the given names"""
+        failed = dict(NotificationQueue(self.env).flush())
+        for name in names:
+            if name in failed:
+                self.fail(name, self.read(name), failed[name])
+            else:
+                os.remove(self.directory(name))
+
+    def fail(self, name, event, error):
+        """reschedule or bury a failed event"""
+        event['attempts'] += 1
+        event['error'] = error
+        self.env.log.error('HookSpool: event %s failed (attempt %d): %s'
+                           % (name, event['attempts'], event['error']))
+        if event['attempts'] >= self.max_attempts:
+            self.bury(name, event)
+            return
+        delay = self.retry_delay * 2 ** (event['attempts'] - 1)
+        event['next_attempt'] = time.time() + delay
+        self.write(self.name(event['next_attempt']), event)
+        os.remove(self.directory(name))
+
+    def bury(self, name, event):
+        """move an event to the dead-letter file"""
+        event['name'] = name
+        f = file(self.directory('dead-letter'), 'a')
+        print >> f, json.dumps(event)
+        f.close()
+        os.remove(self.directory(name))
+
+def option_parser():
+    parser = OptionParser()
+    parser.add_option('-p', '--project', '--projects',
+                      dest='projects', action='append',
+                      default=[],
+                      help='projects to drain the spool of')
+    parser.add_option('--loop', dest='loop', type='float',
+                      help='keep draining, sleeping this many seconds in between')
+    return parser
+
+def main(args=sys.argv[1:]):
+    # imported here as the listener itself needs the spool
+    from repository_hook_system.listener import RepositoryChangeListener
+    from trac.env import open_environment
+
+    class SpooledChangeListener(RepositoryChangeListener):
+        """runs the spooled events synchronously"""
+        use_cache = True
+        spool = False
+
+    parser = option_parser()
+    options, args = parser.parse_args(args)
+
+    while True:
+        for project in options.projects:
+            env = open_environment(project, use_cache=True)
+            def process(hookname, *args):
+                SpooledChangeListener(project, hookname, *args)
+            HookSpool(env).drain(process)
+        if not options.loop:
+            break
+        time.sleep(options.loop)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""
+changesets for uncommitted svn transactions, as seen by pre-commit hooks
+"""
+
+import subprocess
+
+from dateutil.parser import parse
+from fnmatch import fnmatchcase
+from tempfile import SpooledTemporaryFile
+from trac.versioncontrol.api import Changeset
+from trac.versioncontrol.api import Node
+from utils import lazy
+
+try:
+    from svn import core, fs, repos
+except ImportError:
+    core = None # no bindings: use svnlook
+
+class TransactionChangeset(object):
+    """
+    changeset of an svn transaction;  author, date and message are read
+    in one call when the changeset is made, everything else is read
+    the first time a subscriber asks for it
+    """
+
+    # svnlook changed status -> trac change
+    actions = { 'A': Changeset.ADD,
+                'D': Changeset.DELETE,
+                'U': Changeset.EDIT,
+                '_': Changeset.EDIT }
+
+    chunk_size = 65536 # bytes read from svnlook at a time
+    header_size = 65536 # longest line of a diff taken for a header
+    spool_size = 1048576 # bytes of a diff or file kept in memory
+    max_size = 0 # files larger than this are skipped;  0 for no limit
+    skip_types = () # mime types (globs) of files to skip
+
+    def __init__(self, repository_dir, transaction, svnlook='/usr/bin/svnlook'):
+        self.repository_dir = repository_dir
+        self.rev = transaction
+        self.svnlook_path = svnlook
+
+        if core is None or not self.read_bindings():
+            self.read_svnlook()
+
+    def svnlook(self, subcommand, *args):
+        """return the output of svnlook for the transaction"""
+        return self.pipe(subcommand, *args).communicate()[0]
+
+    def pipe(self, subcommand, *args, **kwargs):
+        """svnlook for the transaction, its output on a pipe"""
+        command = [ self.svnlook_path, subcommand, self.repository_dir,
+                    '-t', self.rev ] + list(args)
+        return subprocess.Popen(command, stdout=subprocess.PIPE, **kwargs)
+
+    def read_svnlook(self):
+        """read the basic attributes from a single `svnlook info`"""
+        author, date, size, message = self.svnlook('info').split('\n', 3)
+        self.author = author.strip()
+        self.date = parse(date.split('(')[0].strip())
+        self.message = message[:int(size)].strip()
+
+    def read_bindings(self):
+        """
+        read the basic attributes with the svn bindings;
+        returns False if the transaction could not be opened this way
+        """
+        try:
+            txn = self.transaction()
+            prop = lambda name: fs.svn_fs_txn_prop(txn, name) or ''
+            self.author = prop(core.SVN_PROP_REVISION_AUTHOR).strip()
+            self.date = parse(prop(core.SVN_PROP_REVISION_DATE))
+            self.message = prop(core.SVN_PROP_REVISION_LOG).strip()
+        except core.SubversionException:
+            return False
+        return True
+
+    def transaction(self):
+        """the svn bindings transaction object"""
+        repository = repos.svn_repos_open(self.repository_dir)
+        return fs.svn_fs_open_txn(repos.svn_repos_fs(repository), self.rev)
+
+    ### attributes read on demand
+
+    @lazy
+    def changes(self):
+        """list of (status, path) as given by `svnlook changed`"""
+        changes = []
+        for line in self.svnlook('changed').splitlines():
+            if line.strip():
+                changes.append((line[:3].strip(), line[4:]))
+        return changes
+
+    @lazy
+    def diff(self):
+        """
+        the unified diff of the transaction;
+        see diffs() for transactions too large to hold in memory
+        """
+        return self.svnlook('diff')
+
+    @lazy
+    def properties(self):
+        """dictionary of the revision properties of the transaction"""
+        names = [ name.strip() for name in
+                  self.svnlook('proplist', '--revprop').splitlines()
+                  if name.strip() ]
+        return dict([(name, self.svnlook('propget', '--revprop', name))
+                     for name in names ])
+
+    def get_changes(self):
+        """
+        generator in the manner of trac's Changeset.get_changes:
+        yields (path, kind, change, base_path, base_rev) tuples;
+        copy sources are not reported
+        """
+        for status, path in self.changes:
+            kind = path.endswith('/') and Node.DIRECTORY or Node.FILE
+            change = self.actions.get(status[0], Changeset.EDIT)
+            yield path.rstrip('/'), kind, change, None, None
+
+    ### streaming access to the diffs and contents of files
+
+    def diffs(self, max_size=None, skip_types=None):
+        """
+        generator of (path, diff) for the changed files, read from a
+        single `svnlook diff` in chunks, so a huge line isn't held
+        whole;  diff is a file object, which is spooled to disk past
+        spool_size.  Files skipped for their size or mime type are not
+        yielded
+        """
+        process = self.pipe('diff')
+        path = None
+        diff = None
+        buffer = '' # read but not written yet, from a line start on
+        midline = False # whether buffer starts within a line
+        eof = False
+        try:
+            while not eof:
+                chunk = process.stdout.read(self.chunk_size)
+                eof = not chunk
+                buffer += chunk
+                position = 0
+                while position < len(buffer):
+                    newline = buffer.find('\n', position)
+                    if newline < 0:
+                        end = len(buffer)
+                    else:
+                        end = newline + 1
+                    line = buffer[position:end]
+                    if not midline and len(line) <= self.header_size and \
+                            may_be_header(line):
+                        # a header is told by the start of the line after it
+                        if not eof and (newline < 0 or len(buffer) < end + 4):
+                            break
+                        header = diff_header(line, buffer[end:end + 4])
+                        if header is not None and header != path:
+                            # a property diff follows the diff of the same file
+                            if diff is not None:
+                                diff.seek(0)
+                                yield path, diff
+                            path = header
+                            diff = None
+                            if not self.skip(path, max_size, skip_types):
+                                diff = SpooledTemporaryFile(self.spool_size)
+                    if diff is not None:
+                        diff.write(line)
+                    midline = newline < 0
+                    position = end
+                buffer = buffer[position:]
+            if diff is not None:
+                diff.seek(0)
+                yield path, diff
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    def contents(self, max_size=None, skip_types=None):
+        """
+        generator of (path, contents) for the added and modified files;
+        contents is a file object, which is spooled to disk past
+        spool_size.  Files are checked for their size and mime type
+        before they are read
+        """
+        for path, kind, change, base_path, base_rev in self.get_changes():
+            if kind != Node.FILE or change == Changeset.DELETE:
+                continue
+            if self.skip(path, max_size, skip_types):
+                continue
+            yield path, self.cat(path)
+
+    def cat(self, path):
+        """the contents of a file of the transaction, read in chunks"""
+        process = self.pipe('cat', path)
+        contents = SpooledTemporaryFile(self.spool_size)
+        try:
+            while True:
+                chunk = process.stdout.read(self.chunk_size)
+                if not chunk:
+                    break
+                contents.write(chunk)
+        finally:
+            process.stdout.close()
+            process.wait()
+        contents.seek(0)
+        return contents
+
+    def skip(self, path, max_size=None, skip_types=None):
+        """
+        whether the file is to be skipped for its size or mime type;
+        the limits default to those of the changeset
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if skip_types is None:
+            skip_types = self.skip_types
+        if max_size and self.file_size(path) > max_size:
+            return True
+        if skip_types:
+            mime_type = self.mime_type(path)
+            if mime_type is not None and \
+                    [ pattern for pattern in skip_types
+                      if fnmatchcase(mime_type, pattern) ]:
+                return True
+        return False
+
+    def file_size(self, path):
+        """size of a file of the transaction;  0 if it has none (deleted)"""
+        output = self.pipe('filesize', path,
+                           stderr=subprocess.PIPE).communicate()[0]
+        try:
+            return int(output)
+        except ValueError:
+            return 0
+
+    def mime_type(self, path):
+        """svn:mime-type of a file of the transaction, or None"""
+        output = self.pipe('propget', 'svn:mime-type', path,
+                           stderr=subprocess.PIPE).communicate()[0]
+        return output.strip() or None
+
+# lines of `svnlook diff` starting the diff of a path;  the same
+# words start the diffs of properties, without the underline
+diff_headers = [ 'Modified: ', 'Added: ', 'Deleted: ', 'Copied: ',
+                 'Property changes on: ' ]
+
+def may_be_header(line):
+    """whether a line, or the start read of it, may be a diff header"""
+    for header in diff_headers:
+        if line.startswith(header) or header.startswith(line):
+            return True
+    return False
+
+def diff_header(line, next_line):
+    """the path of a line starting the diff of a path, or None"""
+    if not next_line.startswith('====') and not next_line.startswith('____'):
+        return None
+    for header in diff_headers:
+        if line.startswith(header):
+            path = line[len(header):].rstrip('\r\n')
+            if header == 'Copied: ': # Copied: path (from rev N, source)
+                path = path.rsplit(' (from ', 1)[0]
+            return path
+    return None
@@ -3,15 +3,15 @@ implementation of the RepositoryChangeListener interface for svn
 """
 
 import os
-import subprocess
-
-from dateutil.parser import parse
 
 from genshi.builder import tag
+from repository_hook_system.dispatch import DispatchTable
 from repository_hook_system.filesystemhooks import FileSystemHooks
 from repository_hook_system.interface import IRepositoryChangeListener
 from repository_hook_system.interface import IRepositoryHookSubscriber
 from repository_hook_system.interface import IRepositoryHookSystem
+from repository_hook_system.svnchangeset import TransactionChangeset
+from trac.config import IntOption
 from trac.config import Option
 from trac.config import ListOption
 from trac.core import *
@@ -29,6 +29,15 @@ class SVNHookSystem(FileSystemHooks):
 
 
     _svnlook = Option('svn', 'svnlook', default='/usr/bin/svnlook')
+    _sync_policy = Option('repository-hook-system', 'sync-policy', default='hook',
+                          doc='"hook" to sync the repository cache only as far as each hook needs, "always" to sync it fully on every hook')
+    _memory_limit = IntOption('repository-hook-system', 'transaction-memory-limit', default=1048576,
+                            doc='bytes of a diff or file of a transaction kept in memory before spilling to a temporary file')
+    _max_file_size = IntOption('repository-hook-system', 'transaction-max-file-size', default=0,
+                               doc='size in bytes past which files of a transaction are skipped by diffs() and contents();  0 for no limit')
+    _skip_mime_types = ListOption('repository-hook-system', 'transaction-skip-mime-types', default='',
+                                  doc='mime types (globs, e.g. image/*) of the files of a transaction skipped by diffs() and contents()')
+    _dispatch = None # DispatchTable of the subscribers
 
     ### methods for FileSystemHooks
 
@@ -36,18 +45,22 @@ class SVNHookSystem(FileSystemHooks):
         location = self.env.config.get('trac', 'repository_dir')
         return os.path.join(location, 'hooks', hookname)
 
-    def args(self):
+    def args(self, hookname=None):
+        if hookname == 'post-revprop-change':
+            # the property name;  svn passes its old value on stdin
+            return [ '$2', '$4', '--stdin' ]
         return [ '$2' ]
 
     ### methods for IRepositoryHookAdminContributer
 
     def render(self, hookname, req):
         filename = self.filename(hookname)
-        try:
-            contents = file(filename).read() # check for CRLF here too?
+        hook_file = self.hook_file(hookname)
+        if hook_file is not None:
+            contents = hook_file.contents # check for CRLF here too?
             return tag.textarea(contents, rows='25', cols='80', name='hook-file-contents', disabled=not self.can_enable(hookname) or None)
 
-        except IOError:
+        else:
             if self.can_enable(filename):
                 text = "No %s hook file yet exists;  enable this hook to create one" % hookname
             else:
@@ -67,13 +80,7 @@ class SVNHookSystem(FileSystemHooks):
             if not iswritable(filename):
                 add_warning(req, 'File "%s" not writable' % filename)
                 return
-        f = file(filename, 'w')
-        print >> f, contents
-        f.close()
-        try:
-            os.chmod(filename, self.mode)
-        except: # won't work on winblows
-            pass
+        self.update(hookname, lambda hook_file: contents.split(os.linesep))
 
     ### methods for IRepositoryChangeListener
 
@@ -85,16 +92,32 @@ class SVNHookSystem(FileSystemHooks):
 
     def subscribers(self, hookname):
         """returns the active subscribers for a given hook name"""
-        
-        # XXX this is all SCM-agnostic;  should be moved out
-        return [ subscriber for subscriber in self.listeners 
-                 if subscriber.__class__.__name__ 
-                 in getattr(self, hookname, []) 
-                 and subscriber.is_available(self.type(), hookname) ]
 
-    def changeset(self, repo, hookname, commit_id):
+        if self._dispatch is None:
+            self._dispatch = DispatchTable(self.listeners, self.type())
+        self.env.config.parse_if_needed() # pick up changes to trac.ini
+        return self._dispatch.subscribers(hookname, getattr(self, hookname, []))
+
+    def sync(self, repo, hookname, commit_id, *args):
+        """bring the repository cache up to date as far as the hook needs"""
+        if self._sync_policy == 'always':
+            repo.sync()
+        elif hookname.startswith('pre-'):
+            pass # the transaction isn't in the cache, nor will it be
+        elif hookname == 'post-revprop-change' and hasattr(repo, 'sync_changeset'):
+            repo.sync_changeset(commit_id) # only the revision's metadata changed
+        else:
+            # the cache has to be filled in order, so this syncs up to
+            # the youngest revision -- normally the one just committed.
+            # XXX checking the cache for the revision first costs more
+            # than the sync saves:  it is hardly ever there
+            repo.sync()
+
+    def changeset(self, repo, hookname, commit_id, propname=None, old_value=None):
         """ 
-        return the changeset given the repository object and revision number
+        return the changeset given the repository object and revision number;
+        on post-revprop-change, the changeset has the message before the
+        change as `old_message`
         """
 
         if hookname in ['post-commit', 'post-revprop-change']:
@@ -105,34 +128,23 @@ class SVNHookSystem(FileSystemHooks):
             except NoSuchChangeset:
                 # XXX should probably throw an exception (same one?)
                 raise # out of scope changesets are not cached
+            if hookname == 'post-revprop-change':
+                # hook lines written before the property name was
+                # passed don't tell:  the whole message is applied again
+                if propname is not None and propname != 'svn:log':
+                    # another property changed:  the message didn't
+                    old_value = chgset.message
+                if old_value is not None:
+                    chgset.old_message = old_value
             return chgset
         else:
             transaction = commit_id
             repo = self.env.config.get('trac', 'repository_dir')
-
-            def svnlook(subcommand, *args):
-
-                process = subprocess.Popen([self._svnlook, subcommand, repo, '-t', transaction] + list(args), stdout=subprocess.PIPE)
-                return process.communicate()[0]
-
-            # get the attributes
-            author = svnlook('author').strip()
-            date = parse(svnlook('date').split('(')[0].strip())
-            # XXX FIXME
-#             from datetime import datetime
-#             date = datetime.now()
-
-            
-            message = svnlook('log').strip()
-            rev = transaction
-
-            attributes = dict(author=author,
-                              date=date,
-                              message=message,
-                              rev=rev)
-            chgset = type('DummyChangeset', (object,), attributes)
-            return chgset()
-            
+            chgset = TransactionChangeset(repo, transaction, self._svnlook)
+            chgset.spool_size = self._memory_limit
+            chgset.max_size = self._max_file_size
+            chgset.skip_types = self._skip_mime_types
+            return chgset
 
 for hook in SVNHookSystem.hooks:
     setattr(SVNHookSystem, hook, 
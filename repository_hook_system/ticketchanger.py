@@ -4,25 +4,94 @@ port of http://trac.edgewall.org/browser/trunk/contrib/trac-post-commit-hook
 """
 
 import os
-import re
 import sys
+import threading
+import time
 
-from datetime import datetime
+from repository_hook_system.commitparser import CommitMessageParser
 from repository_hook_system.interface import IRepositoryHookSubscriber
+from repository_hook_system.notification import NotificationQueue
 from trac.config import BoolOption
+from trac.config import IntOption
 from trac.config import ListOption
 from trac.config import Option
 from trac.core import *
 from trac.perm import PermissionCache
+from trac.resource import ResourceNotFound
 from trac.ticket import Ticket
-from trac.ticket.notification import TicketNotifyEmail
 from trac.ticket.web_ui import TicketModule
-from trac.util.datefmt import utc
 
 from trac.web.api import Request # XXX needed for the TicketManipulators
 
 from StringIO import StringIO
 
+class CommitGrammar(object):
+    """the commit message grammar, compiled for a given configuration"""
+
+    def __init__(self, projects, envelope_open, envelope_close, commands):
+        """
+        * projects : intertrac names required before ticket numbers, if any
+        * envelope_open, envelope_close : literals around the commands
+        * commands : dictionary of command name -> function(ticket)
+        """
+        self.parser = CommitMessageParser(projects, envelope_open, envelope_close)
+        self.commands = commands
+
+    def parse(self, message):
+        """returns a dictionary of ticket id -> list of command functions"""
+        tickets = {}
+        for cmd, tkt_ids in self.parser.parse(message):
+            func = self.commands.get(cmd.lower(), None)
+            if func:
+                for tkt_id in tkt_ids:
+                    tickets.setdefault(tkt_id, []).append(func)
+        return tickets
+
+class ValidationContext(object):
+    """
+    the permissions and ticket manipulators validating the tickets
+    changed by a commit author;  made once per author and shared by the
+    tickets of a changeset, and by the changesets of a long-running
+    process for a while.  Each validation gets a fake request of its own,
+    as hooks may run in threads
+    """
+
+    def __init__(self, env, author):
+        self.created = time.time()
+        self.env = env
+        self.author = author
+        self.perm = PermissionCache(env, author)
+        self.manipulators = list(TicketModule(env).ticket_manipulators)
+
+    def request(self, comment):
+        """a fake request of the author posting the comment"""
+        # XXX cargo-culted environ from 
+        # http://trac.edgewall.org/browser/trunk/trac/web/tests/api.py
+        environ = { 'wsgi.url_scheme': 'http',
+                    'wsgi.input': StringIO(''),
+                    'SERVER_NAME': '0.0.0.0',
+                    'REQUEST_METHOD': 'POST',
+                    'SERVER_PORT': 80,
+                    'SCRIPT_NAME': '/' + self.env.project_name,
+                    'REMOTE_USER': self.author,
+                    'QUERY_STRING': ''
+                    }
+        req = Request(environ, None)
+        req.authname = self.author
+        req.perm = self.perm
+        req.args['comment'] = comment
+        return req
+
+    def validate(self, ticket, comment):
+        """
+        run the ticket manipulators on the ticket;
+        returns the comment, as the manipulators may change it
+        """
+        req = self.request(comment)
+        for manipulator in self.manipulators:
+            manipulator.validate_ticket(req, ticket)
+        return req.args['comment']
+
 class TicketChanger(Component):
     """annotes and closes tickets on repository commit messages"""
 
@@ -41,15 +110,41 @@ class TicketChanger(Component):
     cmd_refs = ListOption('ticket-changer', 'references-commands',
                           default='addresses, re, references, refs, see',
                           doc='commit message tokens that indicate ticket reference [e.g. "refs #123"]')
+    validation_ttl = IntOption('ticket-changer', 'validation-cache-ttl', default=300,
+                               doc='seconds the permissions of a commit author are reused for validating tickets')
     
+    _grammar = None # (configuration, CommitGrammar)
+    _contexts = None # author -> ValidationContext
+    _contexts_lock = threading.Lock() # hooks may run in threads
+
     def is_available(self, repository, hookname):
         return True
 
-    def invoke(self, chgset):
+    def grammar(self):
+        """
+        the commit message grammar;  it is compiled once and
+        recompiled only when the relevant configuration changes
+        """
+        self.env.config.parse_if_needed() # pick up changes to trac.ini
+        key = (self.envelope_open, self.envelope_close, self.intertrac,
+               tuple(self.cmd_close), tuple(self.cmd_refs),
+               tuple(self.env.config.options('intertrac')))
+        if self._grammar is None or self._grammar[0] != key:
+            commands = {} # TODO: this could become an extension point
+            commands.update(dict([(name, self._cmdClose) for name in self.cmd_close]))
+            commands.update(dict([(name, self._cmdRefs) for name in self.cmd_refs]))
+            grammar = CommitGrammar(self.intertrac_names(),
+                                    self.envelope_open, self.envelope_close,
+                                    commands)
+            self._grammar = (key, grammar)
+        return self._grammar[1]
 
-        # regular expressions        
-        ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
-        if self.intertrac:  # TODO: split to separate function?
+    def intertrac_names(self):
+        """
+        names of this project one of which must prefix ticket references,
+        or an empty list if intertrac prefixes are not enforced
+        """
+        if self.intertrac:
             # find intertrac links
             intertrac = {}
             aliases = {}
@@ -64,84 +159,130 @@ class TicketChanger(Component):
             project = os.path.basename(self.env.path)
 
             if '/%s' % project in intertrac: # TODO:  checking using base_url for full paths:
-                ticket_prefix = '(?:%s):%s' % ( '|'.join(intertrac['/%s' % project]),
-                                              ticket_prefix )
+                return intertrac['/%s' % project]
             else: # hopefully sesible default:
-                ticket_prefix = '%s:%s' % (project, ticket_prefix)
-
-        ticket_reference = ticket_prefix + '[0-9]+'
-        ticket_command =  (r'(?P<action>[A-Za-z]*).?'
-                           '(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
-                           (ticket_reference, ticket_reference))
-        ticket_command = r'%s%s%s' % (re.escape(self.envelope_open), 
-                                      ticket_command,
-                                      re.escape(self.envelope_close))
-        command_re = re.compile(ticket_command, re.IGNORECASE)
-        ticket_re = re.compile(ticket_prefix + '([0-9]+)', re.IGNORECASE)
-
-        # other variables
+                return [ project ]
+        return []
+
+    def invoke(self, chgset):
+
         msg = "(In [%s]) %s" % (chgset.rev, chgset.message)        
         now = chgset.date
-        supported_cmds = {} # TODO: this could become an extension point
-        supported_cmds.update(dict([(key, self._cmdClose) for key in self.cmd_close]))
-        supported_cmds.update(dict([(key, self._cmdRefs) for key in self.cmd_refs]))
 
-        cmd_groups = command_re.findall(msg)
+        tickets = self.commands(msg)
+        old_message = getattr(chgset, 'old_message', None)
+        if old_message is not None:
+            # an edited log message:  only apply what the edit added
+            old = self.commands("(In [%s]) %s" % (chgset.rev, old_message))
+            for tkt_id, cmds in tickets.items():
+                cmds = [ cmd for cmd in cmds if cmd not in old.get(tkt_id, []) ]
+                if cmds:
+                    tickets[tkt_id] = cmds
+                else:
+                    del tickets[tkt_id]
+        if not tickets:
+            return
 
-        tickets = {}
-        for cmd, tkts in cmd_groups:
-            func = supported_cmds.get(cmd.lower(), None)
-            if func:
-                for tkt_id in ticket_re.findall(tkts):
-                    tickets.setdefault(tkt_id, []).append(func)
+        db = self.env.get_db_cnx()
+        fetched = self.fetch(db, tickets.keys())
+        cnums = self.comment_numbers(db, tickets.keys())
+        savepoints = self.savepoints()
+        context = self.validation_context(chgset.author)
 
-        for tkt_id, cmds in tickets.iteritems():
+        # apply all changes in one transaction;  a savepoint per ticket
+        # keeps one bad ticket from rolling back the others
+        saved = []
+        cursor = db.cursor()
+        for tkt_id, cmds in sorted(tickets.items()):
             try:
-                db = self.env.get_db_cnx()
-                
-                ticket = Ticket(self.env, int(tkt_id), db)
+                if tkt_id not in fetched:
+                    raise ResourceNotFound('Ticket %s does not exist.' % tkt_id)
+                ticket = fetched[tkt_id]
+                if savepoints:
+                    cursor.execute("SAVEPOINT ticket_%d" % tkt_id)
                 for cmd in cmds:
                     cmd(ticket)
 
-                # determine comment sequence number
-                cnum = 0
-                tm = TicketModule(self.env)
-                for change in tm.grouped_changelog_entries(ticket, db):
-                    if change['permanent']:
-                        cnum += 1
-
                 # validate the ticket
-
-                # fake a request
-                # XXX cargo-culted environ from 
-                # http://trac.edgewall.org/browser/trunk/trac/web/tests/api.py
-                environ = { 'wsgi.url_scheme': 'http',
-                            'wsgi.input': StringIO(''),
-                            'SERVER_NAME': '0.0.0.0',
-                            'REQUEST_METHOD': 'POST',
-                            'SERVER_PORT': 80,
-                            'SCRIPT_NAME': '/' + self.env.project_name,
-                            'REMOTE_USER': chgset.author,
-                            'QUERY_STRING': ''
-                            }
-                req = Request(environ, None)
-                req.args['comment'] = msg
-                req.authname = chgset.author
-                req.perm = PermissionCache(self.env, req.authname)
-                for manipulator in tm.ticket_manipulators:
-                    manipulator.validate_ticket(req, ticket)
-                msg = req.args['comment']
-                ticket.save_changes(chgset.author, msg, now, db, cnum+1)
-                db.commit()
-
-                tn = TicketNotifyEmail(self.env)
-                tn.notify(ticket, newticket=0, modtime=now)
+                comment = context.validate(ticket, msg)
+                ticket.save_changes(chgset.author, comment, now, db,
+                                    cnums.get(tkt_id, 0) + 1)
+                if savepoints:
+                    cursor.execute("RELEASE SAVEPOINT ticket_%d" % tkt_id)
+                else:
+                    db.commit()
+                saved.append(ticket)
 
             except Exception, e:
-                message = 'Unexpected error while processing ticket ID %s: %s' % (tkt_id, repr(e))
-                print>>sys.stderr, message
-                self.env.log.error('TicketChanger: ' + message)
-            
+                if savepoints and tkt_id in fetched:
+                    cursor.execute("ROLLBACK TO SAVEPOINT ticket_%d" % tkt_id)
+                elif not savepoints:
+                    db.rollback()
+                self.error(tkt_id, e)
+        db.commit()
+
+        queue = NotificationQueue(self.env)
+        for ticket in saved:
+            queue.enqueue(ticket, now)
+        queue.changeset_done()
+
+    def commands(self, msg):
+        """returns a dictionary of ticket id -> command functions of the message"""
+        tickets = {}
+        for tkt_id, cmds in self.grammar().parse(msg).iteritems():
+            tickets.setdefault(int(tkt_id), []).extend(cmds)
+        return tickets
+
+    def validation_context(self, author):
+        """the ValidationContext of the author, made anew after the ttl"""
+        self._contexts_lock.acquire()
+        try:
+            if self._contexts is None:
+                self._contexts = {}
+            context = self._contexts.get(author)
+            if context is None or time.time() - context.created > self.validation_ttl:
+                context = self._contexts[author] = ValidationContext(self.env, author)
+            return context
+        finally:
+            self._contexts_lock.release()
+
+    def error(self, tkt_id, e):
+        message = 'Unexpected error while processing ticket ID %s: %s' % (tkt_id, repr(e))
+        print>>sys.stderr, message
+        self.env.log.error('TicketChanger: ' + message)
+
+    def savepoints(self):
+        """
+        whether the database can roll back to savepoints;
+        pysqlite commits on its own before a SAVEPOINT, so with sqlite
+        every ticket is committed separately instead
+        """
+        return not self.env.config.get('trac', 'database').startswith('sqlite:')
+
+    def fetch(self, db, ids):
+        """
+        returns a dictionary of id -> Ticket for the ticket ids that exist;
+        loaded by trac's Ticket, in the transaction of the changeset
+        """
+        tickets = {}
+        for tkt_id in ids:
+            try:
+                tickets[tkt_id] = Ticket(self.env, tkt_id, db)
+            except ResourceNotFound:
+                pass # reported when its commands are applied
+        return tickets
+
+    def comment_numbers(self, db, ids):
+        """
+        returns a dictionary of ticket id -> number of the last comment,
+        counting the change groups as TicketModule.grouped_changelog_entries
+        """
+        cursor = db.cursor()
+        cursor.execute("SELECT ticket,COUNT(*) FROM "
+                       "(SELECT DISTINCT ticket,time,author FROM ticket_change "
+                       "WHERE ticket IN (%s)) AS changes GROUP BY ticket"
+                       % ','.join(['%s'] * len(ids)), ids)
+        return dict(cursor.fetchall())
 
     def _cmdClose(self, ticket):
         ticket['status'] = 'closed'
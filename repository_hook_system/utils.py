@@ -5,8 +5,8 @@ roll one's own
 """
 
 import os
-import subprocess
-import sys
+import shlex
+import threading
 
 def iswritable(filename):
     """
@@ -28,15 +28,32 @@ def iswritable(filename):
         os.remove(filename) # remove the file stub
         return True
 
+class lazy(object):
+    """
+    decorator for a method computing an attribute on first access;
+    the value is then stored on the instance, so the method runs once,
+    even with several threads looking at the attribute
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.__name__ = method.__name__
+        self.__doc__ = method.__doc__
+        self.lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        self.lock.acquire()
+        try:
+            if self.__name__ in instance.__dict__:
+                return instance.__dict__[self.__name__] # set meanwhile
+            value = self.method(instance)
+            setattr(instance, self.__name__, value)
+            return value
+        finally:
+            self.lock.release()
+
 def command_line_args(string):
-    p = subprocess.Popen('%s %s %s' % (sys.executable, 
-                                       os.path.abspath(__file__),
-                                       string),
-                         shell=True, stdout=subprocess.PIPE)
-    stdout = p.communicate()[0]
-    args = stdout.split('\n')[:-1]
-    return args
-
-if __name__ == '__main__':
-    for i in sys.argv[1:]:
-        print i
+    """split a command line as the shell would, without running one"""
+    return shlex.split(string)
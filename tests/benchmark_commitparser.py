@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+time the commit message parser, and the regular expression it replaced,
+on generated messages of megabytes:
+
+  python benchmark_commitparser.py [--size MEGABYTES] [--skip-legacy]
+"""
+
+import sys
+import time
+
+from optparse import OptionParser
+from repository_hook_system.commitparser import CommitMessageParser
+from test_commitparser import configurations
+from test_commitparser import legacy_parse
+from test_commitparser import messages
+from test_commitparser import normalized
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser()
+    parser.add_option('--size', dest='size', type='float', default=1.,
+                      help='size of the messages in megabytes [DEFAULT: %default]')
+    parser.add_option('--skip-legacy', dest='legacy', action='store_false',
+                      default=True,
+                      help="don't run the regular expression")
+    options, args = parser.parse_args(args)
+
+    failures = 0
+    size = int(options.size * 1024 * 1024)
+    for name, message in messages(size):
+        for configuration in configurations[:3]:
+            parser = CommitMessageParser(*configuration)
+            start = time.time()
+            result = parser.parse(message)
+            elapsed = time.time() - start
+            line = '%-10s %-24r parser: %8.3fs' % (name, configuration, elapsed)
+            if options.legacy:
+                start = time.time()
+                expected = legacy_parse(message, *configuration)
+                line += '  regex: %8.3fs' % (time.time() - start)
+                if normalized(result) != normalized(expected):
+                    line += '  DIFFERS'
+                    failures += 1
+            print line
+    return failures and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""
+tests of the commit message parser against the regular expression it
+replaced:  on generated messages, and on random short ones made of the
+tokens the grammar cares about;  benchmark_commitparser.py times both
+on messages of megabytes
+"""
+
+import random
+import re
+import time
+import unittest
+
+from repository_hook_system.commitparser import CommitMessageParser
+from repository_hook_system.commitparser import digits
+
+# configurations to compare:  (projects, envelope_open, envelope_close)
+configurations = [ ((), '', ''),
+                   ((), '[', ']'),
+                   (('trac', 'tr'), '', ''),
+                   ((), '', '.'),
+                   ((), '(', ''),
+                   (('trac',), '[', ']') ]
+
+# fragments of the random short messages
+tokens = [ 'fixes', 'refs', 'see', 'and', 'ticket', 'bug', 'issue', 'Ticket',
+           '#', '# ', ',', ' ', '&', ':', '\n', ']', '[', '1', '23', 'x',
+           'close', 'and#', 'trac:', 'tr:', 'Fixes', 'bug:', 'ticket ',
+           '-', '.', '5' ]
+
+def legacy_parse(message, projects=(), envelope_open='', envelope_close=''):
+    """parse the message with the regular expression the parser replaces"""
+    ticket_prefix = '(?:#|(?:ticket|issue|bug)[: ]?)'
+    if projects:
+        ticket_prefix = '(?:%s):%s' % ('|'.join(projects), ticket_prefix)
+    ticket_reference = ticket_prefix + '[0-9]+'
+    ticket_command =  (r'(?P<action>[A-Za-z]*).?'
+                       '(?P<ticket>%s(?:(?:[, &]*|[ ]?and[ ]?)%s)*)' %
+                       (ticket_reference, ticket_reference))
+    ticket_command = r'%s%s%s' % (re.escape(envelope_open),
+                                  ticket_command,
+                                  re.escape(envelope_close))
+    command_re = re.compile(ticket_command, re.IGNORECASE)
+    ticket_re = re.compile(ticket_prefix + '([0-9]+)', re.IGNORECASE)
+    return [ (action, ticket_re.findall(tickets))
+             for action, tickets in command_re.findall(message) ]
+
+def messages(size):
+    """generated commit messages of about size bytes"""
+    random.seed(size)
+    words = [ 'fixes', 'refs', 'see', 'and', 'ticket', 'bug', 'issue',
+              'merged', 'vendor', 'import', 'of', 'the', 'branch' ]
+    tokens = words + [ '#', ',', ' ', '&', ':', '\n', ']', '[' ] + list(digits)
+
+    # a merge log
+    lines = []
+    count = 0
+    while count < size:
+        line = ' '.join([ random.choice(words) for i in range(6) ])
+        line += ' #%d' % random.randint(1, 9999)
+        lines.append(line)
+        count += len(line) + 1
+    yield 'merge log', '\n'.join(lines)
+
+    # random noise of message fragments
+    yield 'noise', ''.join([ random.choice(tokens)
+                             for i in range(size / 3) ])
+
+    # a vendor import:  long runs of letters, as in encoded data
+    yield 'letters', 'refs ' + 'a' * size + ' #1'
+
+def normalized(result):
+    """the actions are matched case-insensitively"""
+    return [ (action.lower(), tickets) for action, tickets in result ]
+
+class CommitMessageParserTest(unittest.TestCase):
+
+    def assertParsesAsLegacy(self, message, configuration):
+        parser = CommitMessageParser(*configuration)
+        self.assertEqual(normalized(parser.parse(message)),
+                         normalized(legacy_parse(message, *configuration)),
+                         '%r differs for %r' % (message, configuration))
+
+    def test_examples(self):
+        parser = CommitMessageParser()
+        self.assertEqual(normalized(parser.parse('fixes #1, #2 and ticket:3; see bug 4')),
+                         [ ('fixes', [ '1', '2', '3' ]), ('see', [ '4' ]) ])
+        parser = CommitMessageParser(('trac',), '[', ']')
+        self.assertEqual(normalized(parser.parse('[refs trac:#5] fixes #6')),
+                         [ ('refs', [ '5' ]) ])
+
+    def test_generated(self):
+        # the regular expression takes quadratic time on long runs of letters
+        for name, message in messages(4096):
+            for configuration in configurations:
+                self.assertParsesAsLegacy(message, configuration)
+
+    def test_fuzz(self):
+        random.seed(0)
+        for i in range(5000):
+            message = ''.join([ random.choice(tokens)
+                                for j in range(random.randint(1, 14)) ])
+            for configuration in configurations:
+                self.assertParsesAsLegacy(message, configuration)
+
+    def test_linear(self):
+        """parsing takes time linear in the size of the message"""
+        elapsed = {}
+        for size in (1, 4):
+            for name, message in messages(size * 131072):
+                for configuration in configurations:
+                    parser = CommitMessageParser(*configuration)
+                    start = time.time()
+                    parser.parse(message)
+                    key = (name, configuration)
+                    elapsed[key] = elapsed.get(key, ()) + (time.time() - start,)
+        for key, (small, large) in elapsed.items():
+            # 4 times the size;  quadratic would be 16 times
+            self.assertTrue(large < 8 * small + 0.1,
+                            '%r took %.3fs for 128KB, %.3fs for 512KB' % (key, small, large))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+tests of the git hook system on a local bare repository pushed to from
+a clone:  which commits a push hands the subscribers, and the changes
+read from `git diff-tree -z`
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from repository_hook_system.githooksystem import GitHookSystem
+from repository_hook_system.githooksystem import null
+from trac.env import Environment
+from trac.versioncontrol.api import Changeset
+from trac.versioncontrol.api import Node
+
+# commits of the tests don't depend on the git configuration of the user
+identity = { 'GIT_AUTHOR_NAME': 'Jane Doe',
+             'GIT_AUTHOR_EMAIL': 'jane@example.org',
+             'GIT_COMMITTER_NAME': 'Jane Doe',
+             'GIT_COMMITTER_EMAIL': 'jane@example.org',
+             'GIT_CONFIG_NOSYSTEM': '1' }
+
+class GitHookSystemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='githooksystem-')
+        self.repository = os.path.join(self.directory, 'repository.git')
+        self.work = os.path.join(self.directory, 'work')
+        self.git(self.directory, 'init', '-q', '--bare', self.repository)
+        self.git(self.directory, 'clone', '-q', self.repository, self.work)
+        self.git(self.work, 'checkout', '-q', '-b', 'master')
+        self.root = self.commit('first', README='the readme\n')
+        self.git(self.work, 'push', '-q', 'origin', 'master')
+
+        project = os.path.join(self.directory, 'project')
+        env = Environment(project, create=True,
+                          options=[('trac', 'repository_type', 'git'),
+                                   ('trac', 'repository_dir', self.repository)])
+        self.hooks = GitHookSystem(env)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def git(self, cwd, *args):
+        environ = os.environ.copy()
+        environ.update(identity)
+        environ['HOME'] = self.directory
+        process = subprocess.Popen(('git',) + args, cwd=cwd, env=environ,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        self.assertEqual(process.returncode, 0,
+                         'git %s failed: %s' % (' '.join(args), error))
+        return output.strip()
+
+    def commit(self, message, **files):
+        """commit files (name -> contents, None to remove) in the clone"""
+        for name, contents in files.items():
+            if contents is None:
+                self.git(self.work, 'rm', '-q', name)
+            else:
+                f = file(os.path.join(self.work, name), 'w')
+                f.write(contents)
+                f.close()
+                self.git(self.work, 'add', name)
+        self.git(self.work, 'commit', '-q', '--allow-empty', '-m', message)
+        return self.git(self.work, 'rev-parse', 'HEAD')
+
+    def push(self, *refspecs):
+        """
+        push from the clone;  returns the lines git passes to the
+        receive hooks
+        """
+        before = self.refs()
+        self.git(self.work, 'push', '-q', '--force', 'origin', *refspecs)
+        after = self.refs()
+        return ''.join([ '%s %s %s\n' % (before.get(ref, null), after.get(ref, null), ref)
+                         for ref in sorted(set(before) | set(after))
+                         if before.get(ref) != after.get(ref) ])
+
+    def refs(self):
+        output = self.git(self.repository, 'for-each-ref',
+                          '--format=%(objectname) %(refname)')
+        return dict([ line.split(' ', 1)[::-1] for line in output.splitlines() ])
+
+    def changesets(self, updates):
+        return [ chgset.rev for chgset in
+                 self.hooks.changesets(None, 'post-receive', updates) ]
+
+    def test_push(self):
+        first = self.commit('second', README='the readme, edited\n')
+        second = self.commit('third')
+        self.assertEqual(self.changesets(self.push('master')), [ first, second ])
+
+    def test_new_branch(self):
+        """commits already on other branches aren't handed again"""
+        self.git(self.work, 'checkout', '-q', '-b', 'feature')
+        feature = self.commit('on the feature branch')
+        updates = self.push('feature')
+        self.assertEqual(updates, '%s %s refs/heads/feature\n' % (null, feature))
+        self.assertEqual(self.changesets(updates), [ feature ])
+
+        # a branch of commits pushed before has no new commits
+        self.git(self.work, 'branch', 'copy', 'feature')
+        self.assertEqual(self.changesets(self.push('copy')), [])
+
+    def test_deletion(self):
+        self.git(self.work, 'checkout', '-q', '-b', 'feature')
+        self.commit('on the feature branch')
+        self.push('feature')
+        updates = self.push(':feature')
+        self.assertTrue(updates.endswith(' %s refs/heads/feature\n' % null))
+        self.assertEqual(self.changesets(updates), [])
+
+    def test_deletion_and_push(self):
+        self.git(self.work, 'checkout', '-q', '-b', 'feature')
+        self.commit('on the feature branch')
+        self.push('feature')
+        self.git(self.work, 'checkout', '-q', 'master')
+        master = self.commit('on master')
+        self.assertEqual(self.changesets(self.push(':feature', 'master')), [ master ])
+
+    def test_force_push(self):
+        """only the commits replacing the old ones are new"""
+        self.commit('to be replaced')
+        self.push('master')
+        self.git(self.work, 'reset', '-q', '--hard', self.root)
+        replacement = self.commit('the replacement')
+        self.assertEqual(self.changesets(self.push('master')), [ replacement ])
+
+    def test_changeset(self):
+        rev = self.commit('fixes #1\n\nwith a body\n')
+        self.push('master')
+        chgset = self.hooks.changeset(None, 'post-receive', rev)
+        self.assertEqual(chgset.rev, rev)
+        self.assertEqual(chgset.message, 'fixes #1\n\nwith a body\n')
+        self.assertEqual(chgset.author, 'Jane Doe <jane@example.org>')
+        self.assertEqual(chgset.parents, [ self.root ])
+
+    def test_changes_of_root(self):
+        chgset = self.hooks.changeset(None, 'post-receive', self.root)
+        self.assertEqual(list(chgset.get_changes()),
+                         [ ('README', Node.FILE, Changeset.ADD, None, None) ])
+
+    def test_changes(self):
+        text = ''.join([ 'line %d of the source\n' % i for i in range(40) ])
+        base = self.commit('sources', **{ 'source.py': text, 'old.py': text * 2,
+                                          'gone.py': 'gone\n' })
+        self.git(self.work, 'mv', 'old.py', 'new name.py')
+        rev = self.commit('changes', **{ 'source.py': text + 'one more\n',
+                                         'copy.py': text,
+                                         'gone.py': None,
+                                         'added.py': 'added\n' })
+        self.push('master')
+        chgset = self.hooks.changeset(None, 'post-receive', rev)
+        changes = sorted(chgset.get_changes())
+        self.assertEqual(changes,
+                         [ ('added.py', Node.FILE, Changeset.ADD, None, None),
+                           ('copy.py', Node.FILE, Changeset.COPY, 'source.py', base),
+                           ('gone.py', Node.FILE, Changeset.DELETE, 'gone.py', base),
+                           ('new name.py', Node.FILE, Changeset.MOVE, 'old.py', base),
+                           ('source.py', Node.FILE, Changeset.EDIT, 'source.py', base) ])
+
+if __name__ == '__main__':
+    unittest.main()
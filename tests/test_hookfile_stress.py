@@ -0,0 +1,112 @@
+"""
+stress test of the locking of hook files:  processes, one per
+throwaway trac environment, enable and disable a hook in a shared hook
+file at random while another process reads the file as a commit would;
+it fails if a read sees a partly written file or an update is lost
+"""
+
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+from repository_hook_system import client
+from repository_hook_system.filesystemhooks import FileSystemHooks
+from repository_hook_system.hookfile import HookFile
+from trac.env import Environment
+from trac.env import open_environment
+
+hookname = 'post-commit'
+projects = 12 # environments changing the hook at once
+changes = 40 # enables and disables by each environment
+
+class StressHooks(FileSystemHooks):
+    """a FileSystemHooks writing to the hooks directory of the test"""
+    abstract = True # not a component of the environments
+
+    def filename(self, hookname):
+        directory = self.env.config.get('trac', 'repository_dir')
+        return os.path.join(directory, 'hooks', hookname)
+
+    def args(self, hookname=None):
+        return [ '$2' ]
+
+def change_hook(project, changes, seed):
+    """
+    enable and disable the hook at random;  the project ends up enabled
+    for odd seeds
+    """
+    hooks = StressHooks(open_environment(project))
+    random.seed(seed)
+    for change in range(changes):
+        if random.random() < .5:
+            hooks.enable(hookname)
+        else:
+            hooks.disable(hookname)
+    if seed % 2:
+        hooks.enable(hookname)
+    else:
+        hooks.disable(hookname)
+
+def read_hook(filename, stop, torn):
+    """read the hook file as a commit would until stopped"""
+    while not stop.is_set():
+        try:
+            contents = file(filename).read()
+        except IOError:
+            continue # not made yet
+        if not contents.startswith('#!/bin/bash') or not contents.endswith('\n'):
+            torn.value += 1
+
+class HookFileStressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='hookfile-stress-')
+        os.makedirs(os.path.join(self.directory, 'hooks'))
+        self.projects = []
+        for index in range(projects):
+            project = os.path.join(self.directory, 'project%d' % index)
+            Environment(project, create=True,
+                        options=[('trac', 'repository_dir', self.directory)])
+            self.projects.append(project)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_enable_disable(self):
+        filename = os.path.join(self.directory, 'hooks', hookname)
+        stop = multiprocessing.Event()
+        torn = multiprocessing.Value('i', 0)
+        reader = multiprocessing.Process(target=read_hook,
+                                         args=(filename, stop, torn))
+        reader.start()
+        start = time.time()
+        writers = [ multiprocessing.Process(target=change_hook,
+                                            args=(project, changes, index))
+                    for index, project in enumerate(self.projects) ]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        elapsed = time.time() - start
+        stop.set()
+        reader.join()
+
+        hook_file = HookFile.load(filename, '# trac repository hook system',
+                                  [ client.filename() ])
+        enabled = set([ os.path.realpath(project) for project in hook_file.projects ])
+        expected = set([ os.path.realpath(project)
+                         for index, project in enumerate(self.projects) if index % 2 ])
+        invocations = [ line for line in hook_file.lines
+                        if client.filename() in line ]
+        message = '%d changes by %d projects in %.1fs' % (
+            projects * changes, projects, elapsed)
+        self.assertEqual(torn.value, 0, 'torn reads;  ' + message)
+        self.assertEqual(enabled, expected, 'lost updates;  ' + message)
+        self.assertEqual(len(invocations), 1, message)
+
+if __name__ == '__main__':
+    unittest.main()